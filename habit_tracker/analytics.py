@@ -1,343 +1,89 @@
-import io
+import os
+import json
+import time
+import hashlib
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from datetime import date, timedelta
-from functools import partial
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 from typing import List, Dict
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib.figure import Figure
-
-# Set Russian locale for dates
-import locale
-try:
-    locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
-except:
-    pass
-
-# Use non-interactive backend
-plt.switch_backend('Agg')
-
-# Thread pool for chart generation (matplotlib is not thread-safe, use 1 worker)
-_chart_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chart_")
-
-# Style settings
-plt.style.use('seaborn-v0_8-whitegrid')
-COLORS = {
-    'primary': '#4CAF50',
-    'secondary': '#2196F3',
-    'warning': '#FFC107',
-    'danger': '#F44336',
-    'success': '#8BC34A',
-    'background': '#FAFAFA'
-}
-
-
-def create_line_chart(
-    dates: List[date],
-    values: List[float],
-    title: str,
-    ylabel: str,
-    goal_line: float = None
-) -> io.BytesIO:
-    """Create a line chart for habit progress."""
-    fig, ax = plt.subplots(figsize=(10, 5))
-    fig.patch.set_facecolor(COLORS['background'])
-    ax.set_facecolor(COLORS['background'])
-
-    # Plot data
-    ax.plot(dates, values, color=COLORS['primary'], linewidth=2, marker='o', markersize=6)
-    ax.fill_between(dates, values, alpha=0.3, color=COLORS['primary'])
-
-    # Goal line
-    if goal_line:
-        ax.axhline(y=goal_line, color=COLORS['danger'], linestyle='--',
-                   linewidth=2, label=f'Цель: {goal_line}')
-        ax.legend(loc='upper right')
-
-    # Formatting
-    ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
-    ax.set_ylabel(ylabel, fontsize=11)
-
-    # Date formatting
-    if len(dates) <= 14:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-        ax.xaxis.set_major_locator(mdates.DayLocator())
-    else:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-        ax.xaxis.set_major_locator(mdates.WeekdayLocator())
-
-    plt.xticks(rotation=45, ha='right')
-    ax.tick_params(axis='both', which='major', labelsize=10)
-
-    # Grid
-    ax.grid(True, linestyle='--', alpha=0.7)
-    ax.set_axisbelow(True)
-
-    plt.tight_layout()
-
-    # Save to buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
-
-
-def create_bar_chart(
-    dates: List[date],
-    values: List[float],
-    title: str,
-    ylabel: str,
-    goal_line: float = None
-) -> io.BytesIO:
-    """Create a bar chart for habit progress."""
-    fig, ax = plt.subplots(figsize=(10, 5))
-    fig.patch.set_facecolor(COLORS['background'])
-    ax.set_facecolor(COLORS['background'])
-
-    # Color bars based on goal completion
-    if goal_line:
-        colors = [COLORS['success'] if v >= goal_line else COLORS['warning'] for v in values]
-    else:
-        colors = [COLORS['primary']] * len(values)
-
-    bars = ax.bar(dates, values, color=colors, width=0.8, edgecolor='white')
-
-    # Goal line
-    if goal_line:
-        ax.axhline(y=goal_line, color=COLORS['danger'], linestyle='--',
-                   linewidth=2, label=f'Цель: {goal_line}')
-        ax.legend(loc='upper right')
-
-    # Formatting
-    ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
-    ax.set_ylabel(ylabel, fontsize=11)
-
-    if len(dates) <= 14:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-    else:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-
-    plt.xticks(rotation=45, ha='right')
-
-    ax.grid(True, axis='y', linestyle='--', alpha=0.7)
-    ax.set_axisbelow(True)
-
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
-
-
-def create_completion_chart(
-    dates: List[date],
-    completed: List[bool],
-    title: str
-) -> io.BytesIO:
-    """Create a completion chart for boolean habits."""
-    fig, ax = plt.subplots(figsize=(10, 3))
-    fig.patch.set_facecolor(COLORS['background'])
-    ax.set_facecolor(COLORS['background'])
-
-    # Create colored squares
-    colors = [COLORS['success'] if c else COLORS['danger'] for c in completed]
-    values = [1] * len(dates)
-
-    ax.bar(dates, values, color=colors, width=0.8, edgecolor='white')
 
-    ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
-    ax.set_ylim(0, 1.5)
-    ax.set_yticks([])
+# Rendering code lives in charts.py and is imported only by the worker
+# processes, so the bot process never loads matplotlib, Pillow or NumPy.
 
-    if len(dates) <= 14:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-    else:
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-        ax.xaxis.set_major_locator(mdates.WeekdayLocator())
 
-    plt.xticks(rotation=45, ha='right')
+def _init_chart_worker():
+    """Load matplotlib and the chart style in a chart worker process."""
+    import charts
+    charts.init_worker()
 
-    # Legend
-    from matplotlib.patches import Patch
-    legend_elements = [
-        Patch(facecolor=COLORS['success'], label='Выполнено'),
-        Patch(facecolor=COLORS['danger'], label='Пропущено')
-    ]
-    ax.legend(handles=legend_elements, loc='upper right')
 
-    plt.tight_layout()
+def _render_chart(name: str, *args) -> bytes:
+    """Run a charts.py function by name inside a worker process."""
+    import charts
+    return getattr(charts, name)(*args)
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
 
-    return buf
+# Process pool for chart generation (matplotlib is not thread-safe, so renders
+# run in separate processes and don't hold the event loop's GIL).
+# Workers are recycled periodically so any matplotlib memory growth stays bounded.
+_CHART_TASKS_PER_WORKER = 100
+_CHART_WORKERS = min(4, os.cpu_count() or 1)
+_chart_executor = ProcessPoolExecutor(
+    max_workers=_CHART_WORKERS,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=_init_chart_worker,
+    max_tasks_per_child=_CHART_TASKS_PER_WORKER
+)
 
 
-def create_streak_chart(habits: List[Dict]) -> io.BytesIO:
-    """Create a horizontal bar chart showing streaks."""
-    fig, ax = plt.subplots(figsize=(10, max(4, len(habits) * 0.6)))
-    fig.patch.set_facecolor(COLORS['background'])
-    ax.set_facecolor(COLORS['background'])
-
-    names = [h['name'][:20] for h in habits]  # Truncate long names
-    streaks = [h['streak'] for h in habits]
-    max_streaks = [h['max_streak'] for h in habits]
-
-    y_pos = range(len(names))
-
-    # Max streak bars (background)
-    ax.barh(y_pos, max_streaks, color=COLORS['secondary'], alpha=0.3,
-            label='Рекорд', height=0.4)
-
-    # Current streak bars
-    ax.barh(y_pos, streaks, color=COLORS['primary'], label='Текущий', height=0.4)
-
-    ax.set_yticks(y_pos)
-    ax.set_yticklabels(names)
-    ax.set_xlabel('Дни', fontsize=11)
-    ax.set_title('🔥 Страйки', fontsize=14, fontweight='bold', pad=15)
-
-    ax.legend(loc='lower right')
-    ax.grid(True, axis='x', linestyle='--', alpha=0.7)
-
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
-
-
-def create_weekly_summary_chart(habits_data: List[Dict]) -> io.BytesIO:
-    """Create weekly summary pie chart."""
-    fig, axes = plt.subplots(1, min(len(habits_data), 3), figsize=(12, 4))
-    fig.patch.set_facecolor(COLORS['background'])
-
-    if len(habits_data) == 1:
-        axes = [axes]
-
-    for i, data in enumerate(habits_data[:3]):
-        ax = axes[i]
-        ax.set_facecolor(COLORS['background'])
+# ============ ASYNC WRAPPERS ============
+# These wrap sync matplotlib functions to run in process pool without blocking event loop
 
-        completed = data.get('completed_days', 0)
-        total = data.get('total_days', 7)
-        missed = total - completed
+# Rendered chart cache: {key: (timestamp, image bytes)}
+_chart_cache: OrderedDict[bytes, tuple] = OrderedDict()
+_CHART_CACHE_SIZE = 256
+_CHART_CACHE_TTL = 60  # 1 minute
+# Renders in progress: {key: future}, so identical concurrent requests share one render
+_chart_inflight: Dict[bytes, asyncio.Future] = {}
 
-        if completed + missed > 0:
-            sizes = [completed, missed]
-            colors = [COLORS['success'], COLORS['danger']]
-            labels = [f'Выполнено\n{completed}', f'Пропущено\n{missed}']
 
-            ax.pie(sizes, labels=labels, colors=colors, autopct='%1.0f%%',
-                   startangle=90, textprops={'fontsize': 9})
+def _chart_cache_key(name: str, *args) -> bytes:
+    """Hash chart function name and input data into a cache key."""
+    payload = json.dumps([name, args], default=str, sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
 
-        habit_name = data['habit']['name']
-        if len(habit_name) > 15:
-            habit_name = habit_name[:15] + '...'
-        ax.set_title(habit_name, fontsize=11, fontweight='bold')
 
-    plt.suptitle('Результаты за неделю', fontsize=14, fontweight='bold', y=1.02)
-    plt.tight_layout()
+async def _render_cached(name: str, *args) -> bytes:
+    """Render charts.<name> in process pool, reusing recent output for identical input."""
+    key = _chart_cache_key(name, *args)
+    cached = _chart_cache.get(key)
+    if cached:
+        ts, data = cached
+        if time.time() - ts < _CHART_CACHE_TTL:
+            _chart_cache.move_to_end(key)
+            return data
+        del _chart_cache[key]
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
+    inflight = _chart_inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
 
-    return buf
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_chart_executor, _render_chart, name, *args)
+    _chart_inflight[key] = future
+    future.add_done_callback(lambda _: _chart_inflight.pop(key, None))
+    # Shielded: a cancelled requester must not cancel the render others are awaiting
+    data = await asyncio.shield(future)
 
+    if data is not None:
+        _chart_cache[key] = (time.time(), data)
+        if len(_chart_cache) > _CHART_CACHE_SIZE:
+            _chart_cache.popitem(last=False)
 
-def generate_habit_report_chart(stats: Dict) -> io.BytesIO:
-    """Generate appropriate chart based on habit type and data."""
-    habit = stats['habit']
-    logs = stats.get('logs', [])
+    return data
 
-    if not logs:
-        return None
-
-    dates = [date.fromisoformat(log['log_date']) for log in logs]
-    values = [log['value'] for log in logs]
-
-    if habit['habit_type'] == 'boolean':
-        completed = [log['completed'] for log in logs]
-        return create_completion_chart(
-            dates,
-            [bool(c) for c in completed],
-            f"📊 {habit['name']}"
-        )
-    else:
-        return create_bar_chart(
-            dates,
-            values,
-            f"📊 {habit['name']}",
-            habit.get('unit', 'Значение'),
-            goal_line=habit['daily_goal']
-        )
-
-
-def generate_leaderboard_chart(participants: List[Dict]) -> io.BytesIO:
-    """Generate leaderboard chart for marathon."""
-    fig, ax = plt.subplots(figsize=(10, max(4, len(participants) * 0.5)))
-    fig.patch.set_facecolor(COLORS['background'])
-    ax.set_facecolor(COLORS['background'])
-
-    names = []
-    points = []
-    for p in participants[:10]:  # Top 10
-        name = p.get('first_name') or p.get('username') or f"User {p['user_id']}"
-        names.append(name[:15])
-        points.append(p['total_points'])
-
-    y_pos = range(len(names))
-    colors = [COLORS['warning'] if i == 0 else
-              COLORS['secondary'] if i == 1 else
-              COLORS['primary'] for i in range(len(names))]
-
-    bars = ax.barh(y_pos, points, color=colors, height=0.6)
-
-    # Add medals for top 3
-    medals = ['🥇', '🥈', '🥉']
-    for i, bar in enumerate(bars[:3]):
-        ax.text(bar.get_width() + 0.5, bar.get_y() + bar.get_height()/2,
-                medals[i], va='center', fontsize=14)
-
-    ax.set_yticks(y_pos)
-    ax.set_yticklabels(names)
-    ax.set_xlabel('Баллы', fontsize=11)
-    ax.set_title('🏆 Таблица лидеров', fontsize=14, fontweight='bold', pad=15)
-
-    ax.invert_yaxis()
-    ax.grid(True, axis='x', linestyle='--', alpha=0.7)
-
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                facecolor=COLORS['background'])
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
-
-
-# ============ ASYNC WRAPPERS ============
-# These wrap sync matplotlib functions to run in thread pool without blocking event loop
 
 async def create_line_chart_async(
     dates: List[date],
@@ -345,13 +91,9 @@ async def create_line_chart_async(
     title: str,
     ylabel: str,
     goal_line: float = None
-) -> io.BytesIO:
+) -> bytes:
     """Async wrapper for create_line_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(create_line_chart, dates, values, title, ylabel, goal_line)
-    )
+    return await _render_cached('create_line_chart', dates, values, title, ylabel, goal_line)
 
 
 async def create_bar_chart_async(
@@ -360,59 +102,56 @@ async def create_bar_chart_async(
     title: str,
     ylabel: str,
     goal_line: float = None
-) -> io.BytesIO:
+) -> bytes:
     """Async wrapper for create_bar_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(create_bar_chart, dates, values, title, ylabel, goal_line)
-    )
+    return await _render_cached('create_bar_chart', dates, values, title, ylabel, goal_line)
 
 
 async def create_completion_chart_async(
     dates: List[date],
     completed: List[bool],
     title: str
-) -> io.BytesIO:
+) -> bytes:
     """Async wrapper for create_completion_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(create_completion_chart, dates, completed, title)
-    )
+    return await _render_cached('create_completion_chart', dates, completed, title)
 
 
-async def create_streak_chart_async(habits: List[Dict]) -> io.BytesIO:
+async def create_streak_chart_async(habits: List[Dict]) -> bytes:
     """Async wrapper for create_streak_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(create_streak_chart, habits)
-    )
+    return await _render_cached('create_streak_chart', habits)
 
 
-async def create_weekly_summary_chart_async(habits_data: List[Dict]) -> io.BytesIO:
+async def create_weekly_summary_chart_async(habits_data: List[Dict]) -> bytes:
     """Async wrapper for create_weekly_summary_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(create_weekly_summary_chart, habits_data)
-    )
+    return await _render_cached('create_weekly_summary_chart', habits_data)
 
 
-async def generate_habit_report_chart_async(stats: Dict) -> io.BytesIO:
+async def generate_habit_report_chart_async(stats: Dict) -> bytes:
     """Async wrapper for generate_habit_report_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(generate_habit_report_chart, stats)
-    )
-
+    logs = stats.get('logs')
+    if not logs:
+        return None
 
-async def generate_leaderboard_chart_async(participants: List[Dict]) -> io.BytesIO:
+    # Send the worker only the fields the chart reads (no comments/timestamps),
+    # which also keeps the cache key stable when those change
+    habit = stats['habit']
+    chart_stats = {
+        'habit': {
+            'name': habit['name'],
+            'habit_type': habit['habit_type'],
+            'unit': habit.get('unit', 'Значение'),
+            'daily_goal': habit['daily_goal']
+        },
+        'logs': [
+            {'log_date': log['log_date'], 'value': log['value'], 'completed': log['completed']}
+            for log in logs
+        ]
+    }
+    return await _render_cached('generate_habit_report_chart', chart_stats)
+
+
+async def generate_leaderboard_chart_async(participants: List[Dict]) -> bytes:
     """Async wrapper for generate_leaderboard_chart."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _chart_executor,
-        partial(generate_leaderboard_chart, participants)
-    )
+    if not participants:
+        return None
+    return await _render_cached('generate_leaderboard_chart', participants)
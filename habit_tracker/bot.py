@@ -42,6 +42,14 @@ async def main():
     dp = Dispatcher(storage=storage)
     dp.include_router(router)
 
+    # Load the user's settings up front in a single query
+    @dp.update.outer_middleware()
+    async def user_settings_middleware(handler, event, data):
+        user = data.get('event_from_user')
+        if user:
+            await db.load_user_settings(user.id)
+        return await handler(event, data)
+
     # Setup scheduler
     logger.info("Setting up scheduler...")
     set_bot(bot)
@@ -55,6 +63,7 @@ async def main():
     finally:
         scheduler.shutdown()
         await bot.session.close()
+        await db.close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,467 @@
+import io
+import os
+import heapq
+import threading
+from datetime import date
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Dict
+import numpy as np
+
+# Pin the headless backend before any other matplotlib import
+os.environ.setdefault('MPLBACKEND', 'Agg')
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.dates as mdates
+from matplotlib import font_manager
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from PIL import Image, ImageDraw, ImageFont
+
+
+def init_worker():
+    """Warm up matplotlib in a chart worker process."""
+    _apply_chart_style()
+
+
+COLORS = {
+    'primary': '#4CAF50',
+    'secondary': '#2196F3',
+    'warning': '#FFC107',
+    'danger': '#F44336',
+    'success': '#8BC34A',
+    'background': '#FAFAFA'
+}
+
+# Style settings (applied on first render, not at import). These are the
+# seaborn-v0_8-whitegrid values the charts rely on, set directly instead of
+# loading and merging the style sheet, with the chart background baked in.
+_STYLE_LOADED = False
+CHART_STYLE = {
+    'axes.axisbelow': True,
+    'axes.edgecolor': '.8',
+    'axes.facecolor': COLORS['background'],
+    'axes.grid': True,
+    'axes.labelcolor': '.15',
+    'axes.linewidth': 1.0,
+    'figure.facecolor': COLORS['background'],
+    'font.family': ['sans-serif'],
+    'font.sans-serif': ['Arial', 'Liberation Sans', 'DejaVu Sans', 'Bitstream Vera Sans', 'sans-serif'],
+    'grid.color': '.8',
+    'grid.linestyle': '-',
+    'legend.frameon': False,
+    'lines.solid_capstyle': 'round',
+    'text.color': '.15',
+    'xtick.color': '.15',
+    'xtick.direction': 'out',
+    'xtick.major.size': 0.0,
+    'xtick.minor.size': 0.0,
+    'ytick.color': '.15',
+    'ytick.direction': 'out',
+    'ytick.major.size': 0.0,
+    'ytick.minor.size': 0.0
+}
+
+# Chart output settings (charts are opaque, so JPEG is smaller and faster to encode than PNG)
+CHART_KW = {
+    'dpi': 100,
+    'quality': 85
+}
+
+# Date axis helpers are stateless between charts, so build them once
+_DATE_FORMATTER = mdates.DateFormatter('%d.%m')
+_DAY_LOCATOR = mdates.DayLocator()
+_WEEK_LOCATOR = mdates.WeekdayLocator()
+
+# Title/label fonts, resolved once instead of from size/weight strings per call
+_TITLE_FONT = font_manager.FontProperties(size=14, weight='bold')
+_SUBTITLE_FONT = font_manager.FontProperties(size=11, weight='bold')
+_LABEL_FONT = font_manager.FontProperties(size=11)
+
+# Leaderboard medals for the top 3
+_MEDALS = ('🥇', '🥈', '🥉')
+
+# Reusable figures with their axes: {(chart, figsize, ncols): [(Figure, axes), ...]}
+# Keyed by chart as well as size: ax.clear() doesn't reset grid and tick
+# settings, so a figure is only reused by the chart that set them up.
+_FIG_POOL: Dict[tuple, List[tuple]] = {}
+_fig_pool_lock = threading.Lock()
+
+
+def _acquire_fig(chart: str, figsize: tuple, ncols: int = 1):
+    """Take a figure with cleared axes from chart's pool (or create one)."""
+    key = (chart, figsize, ncols)
+    with _fig_pool_lock:
+        entries = _FIG_POOL.get(key)
+        entry = entries.pop() if entries else None
+
+    if entry is None:
+        _apply_chart_style()
+        # Not created via pyplot, so it is never tracked by the state machine
+        fig = Figure(figsize=figsize, dpi=CHART_KW['dpi'])
+        FigureCanvasAgg(fig)
+        return fig, fig.subplots(1, ncols)
+
+    # Clearing the existing axes is much cheaper than fig.clf() + new subplots;
+    # clear() keeps the facecolor the axes were created with
+    fig, axes = entry
+    for ax in np.atleast_1d(axes):
+        ax.clear()
+    return fig, axes
+
+
+def _release_fig(fig: Figure, chart: str, figsize: tuple, ncols: int = 1):
+    """Return figure to chart's pool for reuse."""
+    axes = fig.axes[0] if ncols == 1 else np.array(fig.axes)
+    with _fig_pool_lock:
+        _FIG_POOL.setdefault((chart, figsize, ncols), []).append((fig, axes))
+
+
+def _apply_chart_style():
+    """Apply the chart style once per process."""
+    global _STYLE_LOADED
+    if not _STYLE_LOADED:
+        matplotlib.rcParams.update(CHART_STYLE)
+        _STYLE_LOADED = True
+
+
+def _fixed_vertical_margins(height: float) -> Dict[str, float]:
+    """Title/x-label margins in inches, as subplot fractions for a figure of this height."""
+    return {'top': 1 - 0.5 / height, 'bottom': 0.5 / height}
+
+
+def _save_chart(fig: Figure, buf: io.BytesIO):
+    """Render figure with Agg and encode it as JPEG straight from the RGBA buffer."""
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
+    # Read the RGBA buffer as RGBX: alpha is dropped while unpacking, no extra convert pass
+    img = Image.frombuffer('RGB', (width, height), fig.canvas.buffer_rgba(), 'raw', 'RGBX', 0, 1)
+    _encode_image(img, buf)
+
+
+def _encode_image(img: Image.Image, buf: io.BytesIO):
+    """Encode an RGB image into buffer with chart output settings."""
+    img.save(buf, format='JPEG', quality=CHART_KW['quality'], optimize=False, progressive=False)
+
+
+def _draw_bars(ax, x, heights: np.ndarray, colors: List[str], width: float, edgecolor: str):
+    """Draw vertical bars as one PolyCollection (same look as ax.bar, one artist instead of N)."""
+    ax.xaxis.update_units(x)
+    xs = np.asarray(ax.convert_xunits(x), dtype=np.float64)
+    verts = np.zeros((len(xs), 4, 2))
+    verts[:, :2, 0] = (xs - width / 2)[:, None]
+    verts[:, 2:, 0] = (xs + width / 2)[:, None]
+    verts[:, 1:3, 1] = heights[:, None]
+    bars = PolyCollection(verts, facecolors=colors, edgecolors=edgecolor,
+                          linewidths=matplotlib.rcParams['patch.linewidth'])
+    # Like ax.bar: keep the value axis starting exactly at zero
+    bars.sticky_edges.y.append(0)
+    ax.add_collection(bars)
+    ax.autoscale_view()
+    return bars
+
+
+@lru_cache(maxsize=None)
+def _get_font(size: int, bold: bool = False) -> ImageFont.FreeTypeFont:
+    """Load DejaVu Sans (bundled with matplotlib) once per size."""
+    props = font_manager.FontProperties(family='DejaVu Sans', weight='bold' if bold else 'normal')
+    return ImageFont.truetype(font_manager.findfont(props), size)
+
+
+def create_line_chart(
+    dates: List[date],
+    values: List[float],
+    title: str,
+    ylabel: str,
+    goal_line: float = None
+) -> bytes:
+    """Create a line chart for habit progress."""
+    # Convert once: plot() and fill_between() would each unit-convert a list of dates
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=np.float64)
+
+    fig, ax = _acquire_fig('create_line_chart', (10, 5))
+
+    # Plot data
+    ax.plot(dates, values, color=COLORS['primary'], linewidth=2, marker='o', markersize=6)
+    ax.fill_between(dates, values, alpha=0.3, color=COLORS['primary'])
+
+    # Goal line
+    if goal_line:
+        ax.axhline(y=goal_line, color=COLORS['danger'], linestyle='--',
+                   linewidth=2, label=f'Цель: {goal_line}')
+        ax.legend(loc='upper right')
+
+    # Formatting
+    ax.set_title(title, fontproperties=_TITLE_FONT, pad=15)
+    ax.set_ylabel(ylabel, fontproperties=_LABEL_FONT)
+
+    # Date formatting
+    ax.xaxis.set_major_formatter(_DATE_FORMATTER)
+    if len(dates) <= 14:
+        ax.xaxis.set_major_locator(_DAY_LOCATOR)
+    else:
+        ax.xaxis.set_major_locator(_WEEK_LOCATOR)
+
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_ha('right')
+    ax.tick_params(axis='both', which='major', labelsize=10)
+
+    # Grid
+    ax.grid(True, linestyle='--', alpha=0.7)
+
+    fig.subplots_adjust(left=0.08, right=0.97, top=0.9, bottom=0.18)
+
+    # Save to buffer
+    buf = io.BytesIO()
+    _save_chart(fig, buf)
+    _release_fig(fig, 'create_line_chart', (10, 5))
+
+    return buf.getvalue()
+
+
+def create_bar_chart(
+    dates: List[date],
+    values: List[float],
+    title: str,
+    ylabel: str,
+    goal_line: float = None
+) -> bytes:
+    """Create a bar chart for habit progress."""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=np.float64)
+
+    fig, ax = _acquire_fig('create_bar_chart', (10, 5))
+
+    # Color bars based on goal completion
+    if goal_line:
+        colors = np.where(values >= goal_line, COLORS['success'], COLORS['warning']).tolist()
+    else:
+        colors = [COLORS['primary']] * len(values)
+
+    _draw_bars(ax, dates, values, colors, width=0.8, edgecolor='white')
+
+    # Goal line
+    if goal_line:
+        ax.axhline(y=goal_line, color=COLORS['danger'], linestyle='--',
+                   linewidth=2, label=f'Цель: {goal_line}')
+        ax.legend(loc='upper right')
+
+    # Formatting
+    ax.set_title(title, fontproperties=_TITLE_FONT, pad=15)
+    ax.set_ylabel(ylabel, fontproperties=_LABEL_FONT)
+
+    ax.xaxis.set_major_formatter(_DATE_FORMATTER)
+
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_ha('right')
+
+    ax.grid(True, axis='y', linestyle='--', alpha=0.7)
+
+    fig.subplots_adjust(left=0.08, right=0.97, top=0.9, bottom=0.18)
+
+    buf = io.BytesIO()
+    _save_chart(fig, buf)
+    _release_fig(fig, 'create_bar_chart', (10, 5))
+
+    return buf.getvalue()
+
+
+def create_completion_chart(
+    dates: List[date],
+    completed: List[bool],
+    title: str
+) -> bytes:
+    """Create a completion chart for boolean habits (drawn directly with Pillow)."""
+    width, height = 1000, 300  # Same size as a 10x3 figure at 100 dpi
+    margin = 40
+    img = Image.new('RGB', (width, height), COLORS['background'])
+    draw = ImageDraw.Draw(img)
+
+    title_font = _get_font(19, bold=True)
+    label_font = _get_font(13)
+
+    draw.text((width // 2, 13), title, fill='black', font=title_font, anchor='mt')
+
+    # Legend (top right)
+    legend_x = width - margin
+    for color, label in ((COLORS['danger'], 'Пропущено'), (COLORS['success'], 'Выполнено')):
+        legend_x -= draw.textlength(label, font=label_font)
+        draw.text((legend_x, 55), label, fill='black', font=label_font, anchor='lm')
+        legend_x -= 19
+        draw.rectangle([legend_x, 49, legend_x + 12, 61], fill=color)
+        legend_x -= 16
+
+    # Create colored squares
+    if len(dates):
+        step = (width - margin * 2) / len(dates)
+        top, bottom = 77, height - 47
+        label_every = 1 if len(dates) <= 14 else 7
+        fills = np.where(np.asarray(completed, dtype=bool),
+                         COLORS['success'], COLORS['danger']).tolist()
+        iso_days = np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]'), unit='D')
+
+        for i, (iso_day, fill) in enumerate(zip(iso_days, fills)):
+            x0 = margin + i * step + step * 0.1
+            x1 = margin + (i + 1) * step - step * 0.1
+            draw.rectangle([x0, top, x1, bottom], fill=fill)
+            if i % label_every == 0:
+                draw.text(((x0 + x1) / 2, bottom + 8), f"{iso_day[8:10]}.{iso_day[5:7]}",
+                          fill='#333333', font=label_font, anchor='mt')
+
+    buf = io.BytesIO()
+    _encode_image(img, buf)
+    return buf.getvalue()
+
+
+def create_streak_chart(habits: List[Dict]) -> bytes:
+    """Create a horizontal bar chart showing streaks."""
+    figsize = (10, max(4, len(habits) * 0.6))
+    fig, ax = _acquire_fig('create_streak_chart', figsize)
+
+    count = len(habits)
+    names = [h['name'][:20] for h in habits]  # Truncate long names
+    streaks = np.fromiter(map(itemgetter('streak'), habits), dtype=np.int32, count=count)
+    max_streaks = np.fromiter(map(itemgetter('max_streak'), habits), dtype=np.int32, count=count)
+
+    y_pos = np.arange(count)
+
+    # Max streak bars (background)
+    ax.barh(y_pos, max_streaks, color=COLORS['secondary'], alpha=0.3,
+            label='Рекорд', height=0.4)
+
+    # Current streak bars
+    ax.barh(y_pos, streaks, color=COLORS['primary'], label='Текущий', height=0.4)
+
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels(names)
+    ax.set_xlabel('Дни', fontproperties=_LABEL_FONT)
+    ax.set_title('🔥 Страйки', fontproperties=_TITLE_FONT, pad=15)
+
+    ax.legend(loc='lower right')
+    ax.grid(True, axis='x', linestyle='--', alpha=0.7)
+
+    fig.subplots_adjust(left=0.22, right=0.97, **_fixed_vertical_margins(figsize[1]))
+
+    buf = io.BytesIO()
+    _save_chart(fig, buf)
+    _release_fig(fig, 'create_streak_chart', figsize)
+
+    return buf.getvalue()
+
+
+def create_weekly_summary_chart(habits_data: List[Dict]) -> bytes:
+    """Create weekly summary pie chart."""
+    shown = habits_data[:3]
+    ncols = len(shown)
+    fig, axes = _acquire_fig('create_weekly_summary_chart', (12, 4), ncols)
+
+    if ncols == 1:
+        axes = [axes]
+
+    # Rows of (completed, missed) per habit
+    completed_days = np.fromiter((d.get('completed_days', 0) for d in shown), dtype=np.int64, count=ncols)
+    total_days = np.fromiter((d.get('total_days', 7) for d in shown), dtype=np.int64, count=ncols)
+    sizes_arr = np.column_stack((completed_days, total_days - completed_days))
+    colors = [COLORS['success'], COLORS['danger']]
+
+    for ax, (completed, missed), data in zip(axes, sizes_arr, shown):
+        total = completed + missed
+        if total > 0:
+            # Percentages go into the labels: one text artist per wedge, no autopct callback
+            pct_completed = round(100 * completed / total)
+            labels = (f'Выполнено\n{completed} ({pct_completed}%)',
+                      f'Пропущено\n{missed} ({100 - pct_completed}%)')
+            ax.pie((completed, missed), labels=labels, colors=colors, startangle=90,
+                   wedgeprops={'linewidth': 0}, textprops={'fontsize': 9})
+
+        habit_name = data['habit']['name']
+        if len(habit_name) > 15:
+            habit_name = habit_name[:15] + '...'
+        ax.set_title(habit_name, fontproperties=_SUBTITLE_FONT)
+
+    fig.suptitle('Результаты за неделю', fontproperties=_TITLE_FONT)
+    fig.subplots_adjust(left=0.03, right=0.97, top=0.8, bottom=0.05, wspace=0.3)
+
+    buf = io.BytesIO()
+    _save_chart(fig, buf)
+    _release_fig(fig, 'create_weekly_summary_chart', (12, 4), ncols)
+
+    return buf.getvalue()
+
+
+def generate_habit_report_chart(stats: Dict) -> bytes:
+    """Generate appropriate chart based on habit type and data."""
+    habit = stats['habit']
+    logs = stats.get('logs', [])
+
+    if not logs:
+        return None
+
+    # log_date may be a date (asyncpg) or an ISO string; datetime64 accepts both
+    count = len(logs)
+    dates = np.array(list(map(itemgetter('log_date'), logs)), dtype='datetime64[D]')
+
+    if habit['habit_type'] == 'boolean':
+        completed = np.fromiter(map(itemgetter('completed'), logs), dtype=bool, count=count)
+        return create_completion_chart(
+            dates,
+            completed,
+            f"📊 {habit['name']}"
+        )
+    else:
+        values = np.fromiter(map(itemgetter('value'), logs), dtype=np.float64, count=count)
+        return create_bar_chart(
+            dates,
+            values,
+            f"📊 {habit['name']}",
+            habit.get('unit', 'Значение'),
+            goal_line=habit['daily_goal']
+        )
+
+
+def generate_leaderboard_chart(participants: List[Dict]) -> bytes:
+    """Generate leaderboard chart for marathon."""
+    # Top 10 by points, O(N log K); ties keep the incoming order.
+    # Only these are drawn, so everything below (figure height included) uses them.
+    top = heapq.nlargest(10, participants, key=itemgetter('total_points'))
+
+    figsize = (10, max(4, len(top) * 0.5))
+    fig, ax = _acquire_fig('generate_leaderboard_chart', figsize)
+
+    names = []
+    for p in top:
+        name = p.get('first_name') or p.get('username') or f"User {p['user_id']}"
+        names.append(name[:15])
+    points = np.fromiter(map(itemgetter('total_points'), top), dtype=np.float64, count=len(top))
+
+    y_pos = np.arange(len(names))
+    # Gold / silver for the first two ranks, primary for the rest
+    colors = np.where(y_pos == 0, COLORS['warning'],
+                      np.where(y_pos == 1, COLORS['secondary'], COLORS['primary']))
+
+    ax.barh(y_pos, points, color=colors, height=0.6)
+
+    # Add medals for top 3 (bars are centred on y_pos and end at their points)
+    for medal, y, width in zip(_MEDALS, y_pos, points):
+        ax.text(width + 0.5, y, medal, va='center', fontsize=14)
+
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels(names)
+    ax.set_xlabel('Баллы', fontproperties=_LABEL_FONT)
+    ax.set_title('🏆 Таблица лидеров', fontproperties=_TITLE_FONT, pad=15)
+
+    ax.invert_yaxis()
+    ax.grid(True, axis='x', linestyle='--', alpha=0.7)
+
+    fig.subplots_adjust(left=0.2, right=0.95, **_fixed_vertical_margins(figsize[1]))
+
+    buf = io.BytesIO()
+    _save_chart(fig, buf)
+    _release_fig(fig, 'generate_leaderboard_chart', figsize)
+
+    return buf.getvalue()
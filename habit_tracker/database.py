@@ -1,8 +1,11 @@
+import asyncio
 import asyncpg
-from datetime import datetime, date
-from typing import Optional, List, Dict
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date, timedelta
+from typing import AsyncIterator, Optional, List, Dict
 from functools import lru_cache
-import json
 import os
 import time
 
@@ -10,17 +13,64 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 
 # Connection pool
 pool: Optional[asyncpg.Pool] = None
+# A few warm connections for normal traffic, room to grow for scheduler
+# fan-out and broadcasts; a query that hangs fails instead of pinning a connection
+POOL_MIN_SIZE = 4
+POOL_MAX_SIZE = 20
+COMMAND_TIMEOUT = 30  # seconds
+
+# Prepared statements are cached per connection by SQL text, so hot queries
+# shared by several functions use one constant (one cache entry)
+STATEMENT_CACHE_SIZE = 256
+SQL_GET_USER = "SELECT * FROM users WHERE user_id = $1"
+SQL_GET_HABIT = "SELECT * FROM habits WHERE id = $1"
+SQL_GET_DAILY_LOG = "SELECT * FROM habit_logs WHERE habit_id = $1 AND log_date = $2"
+
+# Rows that callers only read are returned as asyncpg Records (they support
+# row['col'] and row.get()); rows that callers modify or send to the chart
+# workers are copied into dicts.
+
+# Columns update_habit() may set
+HABIT_UPDATE_COLUMNS = frozenset({
+    'name', 'daily_goal', 'unit', 'category_id', 'is_active',
+    'streak', 'max_streak', 'marathon_id'
+})
+
+# Per-connection session settings. Commits don't wait for the WAL flush:
+# a crash can lose the last few hundred ms of check-ins, never corrupt data.
+SESSION_SETTINGS = {
+    'synchronous_commit': 'off'
+}
+
+# Bump whenever the DDL or migrations in _create_schema() change;
+# init_db() skips them entirely when the database is already at this version
+SCHEMA_VERSION = 2
+
+# Columns added after the first release: (table, column, type)
+MIGRATION_COLUMNS = (
+    ('habit_logs', 'comment', 'TEXT'),
+    ('pending_notifications', 'message_id', 'BIGINT'),
+    ('pending_notifications', 'chat_id', 'BIGINT'),
+)
+
+# Per-user caches are LRU-bounded so a long-running bot with many users
+# doesn't keep an entry for everyone it has ever seen
+_USER_CACHE_SIZE = 10_000
 
 # Language cache: {user_id: (language, timestamp)}
-_language_cache: Dict[int, tuple] = {}
-_LANGUAGE_CACHE_TTL = 300  # 5 minutes
+_language_cache: OrderedDict[int, tuple] = OrderedDict()
+# set_user_language() writes through to the cache, so the TTL only bounds
+# staleness from changes made outside the bot (e.g. by hand in the database)
+_LANGUAGE_CACHE_TTL = 3600  # 1 hour
 
 
 def _get_cached_language(user_id: int) -> Optional[str]:
     """Get language from cache if not expired."""
-    if user_id in _language_cache:
-        lang, ts = _language_cache[user_id]
+    cached = _language_cache.get(user_id)
+    if cached:
+        lang, ts = cached
         if time.time() - ts < _LANGUAGE_CACHE_TTL:
+            _language_cache.move_to_end(user_id)
             return lang
         del _language_cache[user_id]
     return None
@@ -29,191 +79,346 @@ def _get_cached_language(user_id: int) -> Optional[str]:
 def _set_cached_language(user_id: int, language: str):
     """Set language in cache."""
     _language_cache[user_id] = (language, time.time())
+    _language_cache.move_to_end(user_id)
+    if len(_language_cache) > _USER_CACHE_SIZE:
+        _language_cache.popitem(last=False)
+
+
+# Notification times cache: {user_id: (times, timestamp)}
+_notif_times_cache: OrderedDict[int, tuple] = OrderedDict()
+_NOTIF_TIMES_CACHE_TTL = 300  # 5 minutes
+
+
+def _get_cached_notif_times(user_id: int) -> Optional[List[str]]:
+    """Get notification times from cache if not expired."""
+    cached = _notif_times_cache.get(user_id)
+    if cached:
+        times, ts = cached
+        if time.time() - ts < _NOTIF_TIMES_CACHE_TTL:
+            _notif_times_cache.move_to_end(user_id)
+            return list(times)
+        del _notif_times_cache[user_id]
+    return None
+
+
+def _set_cached_notif_times(user_id: int, times: List[str]):
+    """Set notification times in cache."""
+    _notif_times_cache[user_id] = (tuple(times), time.time())
+    _notif_times_cache.move_to_end(user_id)
+    if len(_notif_times_cache) > _USER_CACHE_SIZE:
+        _notif_times_cache.popitem(last=False)
 
 
 async def init_db():
     """Initialize database with all tables."""
     global pool
-    pool = await asyncpg.create_pool(DATABASE_URL)
+    # Keep connections open for the life of the process instead of
+    # reconnecting after idle periods (default is 5 minutes)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        command_timeout=COMMAND_TIMEOUT,
+        max_inactive_connection_lifetime=0,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+        # Hot statements stay prepared for the life of the connection instead
+        # of being re-prepared every 5 minutes (asyncpg's default lifetime)
+        max_cached_statement_lifetime=0,
+        server_settings=SESSION_SETTINGS
+    )
 
     async with pool.acquire() as conn:
-        # Users table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                language TEXT DEFAULT 'kk',
-                notification_times TEXT DEFAULT '["08:00", "14:00", "21:00"]',
-                created_at TIMESTAMP DEFAULT NOW()
+        # A database already at this schema version needs no DDL at all
+        try:
+            version = await conn.fetchval("SELECT version FROM schema_version")
+        except asyncpg.UndefinedTableError:
+            version = None
+        if version == SCHEMA_VERSION:
+            return
+
+        async with conn.transaction():
+            await _create_schema(conn)
+            await conn.execute(
+                """INSERT INTO schema_version (id, version) VALUES (1, $1)
+                   ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version""",
+                SCHEMA_VERSION
             )
-        """)
 
-        # Categories/Folders table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS categories (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                name TEXT NOT NULL,
-                icon TEXT DEFAULT '📁',
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
 
-        # Marathons table (create before habits due to foreign key)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS marathons (
-                id SERIAL PRIMARY KEY,
-                creator_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                name TEXT NOT NULL,
-                invite_code TEXT UNIQUE NOT NULL,
-                start_date DATE NOT NULL,
-                end_date DATE NOT NULL,
-                is_active INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
+async def _create_schema(conn: asyncpg.Connection):
+    """Create tables and indexes and apply column migrations (idempotent)."""
+    # The whole schema goes to the server as one multi-statement script
+    await conn.execute("""
+        -- Schema version, checked by init_db() on startup (single row)
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+
+        -- Users table
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            language TEXT DEFAULT 'kk',
+            notification_times TEXT[] DEFAULT ARRAY['08:00', '14:00', '21:00'],
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+
+        -- Categories/Folders table
+        CREATE TABLE IF NOT EXISTS categories (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            icon TEXT DEFAULT '📁',
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+
+        -- Marathons table (create before habits due to foreign key)
+        CREATE TABLE IF NOT EXISTS marathons (
+            id SERIAL PRIMARY KEY,
+            creator_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            invite_code TEXT UNIQUE NOT NULL,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+
+        -- Habits table
+        CREATE TABLE IF NOT EXISTS habits (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
+            name TEXT NOT NULL,
+            habit_type TEXT NOT NULL CHECK(habit_type IN ('boolean', 'numeric')),
+            daily_goal REAL DEFAULT 1,
+            unit TEXT DEFAULT '',
+            streak INTEGER DEFAULT 0,
+            max_streak INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            marathon_id INTEGER REFERENCES marathons(id) ON DELETE SET NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+
+        -- Daily logs table
+        CREATE TABLE IF NOT EXISTS habit_logs (
+            id SERIAL PRIMARY KEY,
+            habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            log_date DATE NOT NULL,
+            value REAL DEFAULT 0,
+            completed INTEGER DEFAULT 0,
+            comment TEXT,
+            logged_at TIMESTAMP DEFAULT NOW(),
+            UNIQUE(habit_id, log_date)
+        );
+
+        -- Pending notifications (for 10-min rule)
+        CREATE TABLE IF NOT EXISTS pending_notifications (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
+            message_id BIGINT,
+            chat_id BIGINT,
+            sent_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            responded INTEGER DEFAULT 0
+        );
+
+        -- Marathon participants
+        CREATE TABLE IF NOT EXISTS marathon_participants (
+            id SERIAL PRIMARY KEY,
+            marathon_id INTEGER NOT NULL REFERENCES marathons(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            total_points REAL DEFAULT 0,
+            joined_at TIMESTAMP DEFAULT NOW(),
+            UNIQUE(marathon_id, user_id)
+        );
+
+        -- Marathon habit templates
+        CREATE TABLE IF NOT EXISTS marathon_habits (
+            id SERIAL PRIMARY KEY,
+            marathon_id INTEGER NOT NULL REFERENCES marathons(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            habit_type TEXT NOT NULL CHECK(habit_type IN ('boolean', 'numeric')),
+            daily_goal REAL DEFAULT 1,
+            unit TEXT DEFAULT '',
+            points_per_goal REAL DEFAULT 1
+        );
+
+        -- Indexes for hot lookups (habit_logs(habit_id, log_date) is covered by its UNIQUE constraint)
+        CREATE INDEX IF NOT EXISTS idx_logs_user_date ON habit_logs(user_id, log_date);
+        -- The partial indexes cover only the rows the bot reads (active habits and
+        -- marathons, unanswered notifications), in the order it reads them
+        DROP INDEX IF EXISTS idx_habits_user_active;
+        CREATE INDEX IF NOT EXISTS idx_habits_user_active_order ON habits(user_id, category_id, name) WHERE is_active = 1;
+        CREATE INDEX IF NOT EXISTS idx_habits_marathon ON habits(marathon_id) WHERE marathon_id IS NOT NULL;
+        DROP INDEX IF EXISTS idx_participants_marathon;
+        CREATE INDEX IF NOT EXISTS idx_participants_points ON marathon_participants(marathon_id, total_points DESC) INCLUDE (user_id);
+        DROP INDEX IF EXISTS idx_pending_expired;
+        CREATE INDEX IF NOT EXISTS idx_pending_expiring ON pending_notifications(expires_at) WHERE responded = 0;
+        DROP INDEX IF EXISTS idx_marathons_active;
+        CREATE INDEX IF NOT EXISTS idx_marathons_active_window ON marathons(start_date, end_date) WHERE is_active = 1;
+        CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at);
+        CREATE INDEX IF NOT EXISTS idx_logs_logged_at ON habit_logs(logged_at);
+    """)
+
+    # Add new columns if they don't exist (migration), one ALTER per table.
+    # This only runs on a schema version bump, so no need to look them up first.
+    new_columns: Dict[str, List[str]] = {}
+    for table, column, col_type in MIGRATION_COLUMNS:
+        new_columns.setdefault(table, []).append(f"ADD COLUMN IF NOT EXISTS {column} {col_type}")
+    for table, clauses in new_columns.items():
+        await conn.execute(f"ALTER TABLE {table} {', '.join(clauses)}")
+
+    # Needs habit_logs.comment, which older databases only get from the migration above
+    await conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_logs_comments ON habit_logs(habit_id, log_date DESC)
+           WHERE comment IS NOT NULL AND comment != ''"""
+    )
+
+    # notification_times used to be TEXT (JSON, later comma-separated);
+    # convert once to a native array, which handles both formats
+    times_type = await conn.fetchval(
+        """SELECT data_type FROM information_schema.columns
+           WHERE table_schema = current_schema()
+             AND table_name = 'users' AND column_name = 'notification_times'"""
+    )
+    if times_type == 'text':
+        await conn.execute(
+            """ALTER TABLE users
+               ALTER COLUMN notification_times DROP DEFAULT,
+               ALTER COLUMN notification_times TYPE TEXT[]
+                   USING string_to_array(translate(notification_times, '[]" ', ''), ','),
+               ALTER COLUMN notification_times SET DEFAULT ARRAY['08:00', '14:00', '21:00']"""
+        )
 
-        # Habits table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS habits (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
-                name TEXT NOT NULL,
-                habit_type TEXT NOT NULL CHECK(habit_type IN ('boolean', 'numeric')),
-                daily_goal REAL DEFAULT 1,
-                unit TEXT DEFAULT '',
-                streak INTEGER DEFAULT 0,
-                max_streak INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1,
-                marathon_id INTEGER REFERENCES marathons(id) ON DELETE SET NULL,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
 
-        # Daily logs table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS habit_logs (
-                id SERIAL PRIMARY KEY,
-                habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                log_date DATE NOT NULL,
-                value REAL DEFAULT 0,
-                completed INTEGER DEFAULT 0,
-                comment TEXT,
-                logged_at TIMESTAMP DEFAULT NOW(),
-                UNIQUE(habit_id, log_date)
-            )
-        """)
+async def close_db():
+    """Close the connection pool."""
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
 
-        # Pending notifications (for 10-min rule)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS pending_notifications (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
-                message_id BIGINT,
-                chat_id BIGINT,
-                sent_at TIMESTAMP NOT NULL,
-                expires_at TIMESTAMP NOT NULL,
-                responded INTEGER DEFAULT 0
-            )
-        """)
 
-        # Add new columns if they don't exist (migration)
-        try:
-            await conn.execute("ALTER TABLE habit_logs ADD COLUMN IF NOT EXISTS comment TEXT")
-        except:
-            pass
+# Connection bound by request_connection(), with the task that bound it:
+# (connection, task)
+_request_conn: ContextVar[Optional[tuple]] = ContextVar('request_conn', default=None)
+
+
+def _current_request_conn() -> Optional[asyncpg.Connection]:
+    """The connection bound by request_connection() in this task, if any.
+
+    Tasks started inside the block (asyncio.gather, create_task) inherit the
+    context variable but must not share the connection, so they get None.
+    """
+    bound = _request_conn.get()
+    if bound is not None and bound[1] is asyncio.current_task():
+        return bound[0]
+    return None
+
+
+@asynccontextmanager
+async def request_connection():
+    """Run every query made inside the block on one pooled connection.
+
+    Saves an acquire/release (and asyncpg's reset query) per database call
+    for a run of queries with nothing else in between. Keep Telegram calls
+    and other slow awaits outside the block: the connection is held until
+    it exits.
+    """
+    if _current_request_conn() is not None:
+        yield
+        return
+
+    async with pool.acquire() as conn:
+        token = _request_conn.set((conn, asyncio.current_task()))
         try:
-            await conn.execute("ALTER TABLE pending_notifications ADD COLUMN IF NOT EXISTS message_id BIGINT")
-            await conn.execute("ALTER TABLE pending_notifications ADD COLUMN IF NOT EXISTS chat_id BIGINT")
-        except:
-            pass
-
-        # Marathon participants
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS marathon_participants (
-                id SERIAL PRIMARY KEY,
-                marathon_id INTEGER NOT NULL REFERENCES marathons(id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                total_points REAL DEFAULT 0,
-                joined_at TIMESTAMP DEFAULT NOW(),
-                UNIQUE(marathon_id, user_id)
-            )
-        """)
+            yield
+        finally:
+            _request_conn.reset(token)
 
-        # Marathon habit templates
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS marathon_habits (
-                id SERIAL PRIMARY KEY,
-                marathon_id INTEGER NOT NULL REFERENCES marathons(id) ON DELETE CASCADE,
-                name TEXT NOT NULL,
-                habit_type TEXT NOT NULL CHECK(habit_type IN ('boolean', 'numeric')),
-                daily_goal REAL DEFAULT 1,
-                unit TEXT DEFAULT '',
-                points_per_goal REAL DEFAULT 1
-            )
-        """)
+
+@asynccontextmanager
+async def _acquire():
+    """Connection for a query: the current request's, or one from the pool."""
+    conn = _current_request_conn()
+    if conn is not None:
+        yield conn
+        return
+
+    async with pool.acquire() as conn:
+        yield conn
 
 
 # ============ USER FUNCTIONS ============
 
 async def get_or_create_user(user_id: int, username: str = None, first_name: str = None) -> dict:
     """Get existing user or create new one."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+    async with _acquire() as conn:
+        row = await conn.fetchrow(SQL_GET_USER, user_id)
 
         if row:
             return dict(row)
 
-        await conn.execute(
-            "INSERT INTO users (user_id, username, first_name) VALUES ($1, $2, $3)",
-            user_id, username, first_name
-        )
-
-        # Create default categories
-        default_categories = [
-            ("🏃 Здоровье", "🏃"),
-            ("🕌 Духовное", "🕌"),
-            ("📚 Образование", "📚")
-        ]
-        for name, icon in default_categories:
-            await conn.execute(
+        async with conn.transaction():
+            # Two first messages can race here; the loser takes the row the winner made
+            row = await conn.fetchrow(
+                """INSERT INTO users (user_id, username, first_name) VALUES ($1, $2, $3)
+                   ON CONFLICT (user_id) DO NOTHING RETURNING *""",
+                user_id, username, first_name
+            )
+            if row is None:
+                return dict(await conn.fetchrow(SQL_GET_USER, user_id))
+
+            # Create default categories
+            default_categories = [
+                ("🏃 Здоровье", "🏃"),
+                ("🕌 Духовное", "🕌"),
+                ("📚 Образование", "📚")
+            ]
+            await conn.executemany(
                 "INSERT INTO categories (user_id, name, icon) VALUES ($1, $2, $3)",
-                user_id, name, icon
+                [(user_id, name, icon) for name, icon in default_categories]
             )
 
-        row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
         return dict(row)
 
 
 async def update_notification_times(user_id: int, times: List[str]):
     """Update user's notification times."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "UPDATE users SET notification_times = $1 WHERE user_id = $2",
-            json.dumps(times), user_id
+            times, user_id
         )
+    _notif_times_cache.pop(user_id, None)
 
 
 async def get_user_notification_times(user_id: int) -> List[str]:
-    """Get user's notification times."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
+    """Get user's notification times (with caching)."""
+    cached = _get_cached_notif_times(user_id)
+    if cached is not None:
+        return cached
+
+    async with _acquire() as conn:
+        times = await conn.fetchval(
             "SELECT notification_times FROM users WHERE user_id = $1", user_id
         )
-        if row:
-            return json.loads(row['notification_times'])
+        if times:
+            _set_cached_notif_times(user_id, times)
+            return times
         return ["08:00", "14:00", "21:00"]
 
 
 async def get_all_users() -> List[dict]:
-    """Get all users."""
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM users")
-        return [dict(row) for row in rows]
+    """Get all users (only user_id is loaded)."""
+    async with _acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM users")
+        return [{'user_id': row[0]} for row in rows]
 
 
 async def get_user_language(user_id: int) -> str:
@@ -223,18 +428,39 @@ async def get_user_language(user_id: int) -> str:
     if cached:
         return cached
 
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
+    async with _acquire() as conn:
+        lang = await conn.fetchval(
             "SELECT language FROM users WHERE user_id = $1", user_id
-        )
-        lang = row['language'] if row and row['language'] else "kk"
+        ) or "kk"
         _set_cached_language(user_id, lang)
         return lang
 
 
+async def load_user_settings(user_id: int):
+    """Warm the language and notification-time caches with one query.
+
+    Called once per update, so the handler's get_user_language() (and
+    get_user_notification_times()) calls are served from cache.
+    """
+    if _get_cached_language(user_id):
+        return
+
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT language, notification_times FROM users WHERE user_id = $1", user_id
+        )
+    # Unknown users are left uncached until /start creates them
+    if row is None:
+        return
+
+    _set_cached_language(user_id, row['language'] or "kk")
+    if row['notification_times']:
+        _set_cached_notif_times(user_id, row['notification_times'])
+
+
 async def set_user_language(user_id: int, language: str):
     """Set user's language preference."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "UPDATE users SET language = $1 WHERE user_id = $2",
             language, user_id
@@ -245,19 +471,19 @@ async def set_user_language(user_id: int, language: str):
 
 # ============ CATEGORY FUNCTIONS ============
 
-async def get_user_categories(user_id: int) -> List[dict]:
+async def get_user_categories(user_id: int) -> List[asyncpg.Record]:
     """Get all categories for a user."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             "SELECT * FROM categories WHERE user_id = $1 ORDER BY name",
             user_id
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 async def create_category(user_id: int, name: str, icon: str = "📁") -> int:
     """Create a new category."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "INSERT INTO categories (user_id, name, icon) VALUES ($1, $2, $3) RETURNING id",
             user_id, name, icon
@@ -267,13 +493,13 @@ async def create_category(user_id: int, name: str, icon: str = "📁") -> int:
 
 async def delete_category(category_id: int):
     """Delete a category."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute("DELETE FROM categories WHERE id = $1", category_id)
 
 
 async def get_category(category_id: int) -> Optional[dict]:
     """Get a single category by ID."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM categories WHERE id = $1", category_id)
         return dict(row) if row else None
 
@@ -290,7 +516,7 @@ async def create_habit(
     marathon_id: int = None
 ) -> int:
     """Create a new habit."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """INSERT INTO habits (user_id, name, habit_type, daily_goal, unit, category_id, marathon_id)
                VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id""",
@@ -301,7 +527,7 @@ async def create_habit(
 
 async def get_user_habits(user_id: int, active_only: bool = True) -> List[dict]:
     """Get all habits for a user."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         if active_only:
             rows = await conn.fetch(
                 "SELECT * FROM habits WHERE user_id = $1 AND is_active = 1 ORDER BY category_id, name",
@@ -315,9 +541,59 @@ async def get_user_habits(user_id: int, active_only: bool = True) -> List[dict]:
         return [dict(row) for row in rows]
 
 
+async def get_user_habits_with_today_log(user_id: int, log_date: date = None) -> List[dict]:
+    """Get a user's active habits with the day's progress in one query.
+
+    Each habit gets 'completed_today' and 'today_value' (0 when nothing is logged).
+    """
+    if log_date is None:
+        log_date = date.today()
+
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT h.*,
+                      COALESCE(l.completed, 0) AS completed_today,
+                      COALESCE(l.value, 0) AS today_value
+               FROM habits h
+               LEFT JOIN habit_logs l ON l.habit_id = h.id AND l.log_date = $2
+               WHERE h.user_id = $1 AND h.is_active = 1
+               ORDER BY h.category_id, h.name""",
+            user_id, log_date
+        )
+        return [dict(row) for row in rows]
+
+
+async def get_uncompleted_habits_due_at(check_time: str, log_date: date = None) -> Dict[int, List[dict]]:
+    """Get uncompleted habits of every user with a notification at check_time.
+
+    Returns {user_id: [habit, ...]} in one query; users with nothing left to do
+    are omitted. Users without notification times get the defaults.
+    """
+    if log_date is None:
+        log_date = date.today()
+
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT h.*, 0 AS completed_today, COALESCE(l.value, 0) AS today_value
+               FROM users u
+               JOIN habits h ON h.user_id = u.user_id AND h.is_active = 1
+               LEFT JOIN habit_logs l ON l.habit_id = h.id AND l.log_date = $2
+               WHERE $1 = ANY(COALESCE(NULLIF(u.notification_times, '{}'),
+                                       ARRAY['08:00', '14:00', '21:00']))
+                 AND COALESCE(l.completed, 0) = 0
+               ORDER BY h.user_id, h.category_id, h.name""",
+            check_time, log_date
+        )
+
+    habits_by_user: Dict[int, List[dict]] = {}
+    for row in rows:
+        habits_by_user.setdefault(row['user_id'], []).append(dict(row))
+    return habits_by_user
+
+
 async def get_habits_by_category(user_id: int, category_id: Optional[int], active_only: bool = True) -> List[dict]:
     """Get habits for a user filtered by category."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         if category_id is None:
             if active_only:
                 rows = await conn.fetch(
@@ -345,25 +621,33 @@ async def get_habits_by_category(user_id: int, category_id: Optional[int], activ
 
 async def get_habit(habit_id: int) -> Optional[dict]:
     """Get a single habit."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM habits WHERE id = $1", habit_id)
+    async with _acquire() as conn:
+        row = await conn.fetchrow(SQL_GET_HABIT, habit_id)
         return dict(row) if row else None
 
 
 async def update_habit(habit_id: int, **kwargs):
     """Update habit fields."""
-    async with pool.acquire() as conn:
-        for key, value in kwargs.items():
-            await conn.execute(
-                f"UPDATE habits SET {key} = $1 WHERE id = $2",
-                value, habit_id
-            )
+    if not kwargs:
+        return
+    unknown = kwargs.keys() - HABIT_UPDATE_COLUMNS
+    if unknown:
+        raise ValueError(f"Cannot update habit columns: {', '.join(sorted(unknown))}")
+
+    # Sorted keys give one stable SQL text per column set for the statement cache
+    keys = sorted(kwargs)
+    assignments = ", ".join(f"{key} = ${i}" for i, key in enumerate(keys, start=2))
+    async with _acquire() as conn:
+        await conn.execute(
+            f"UPDATE habits SET {assignments} WHERE id = $1",
+            habit_id, *(kwargs[key] for key in keys)
+        )
 
 
 async def delete_habit(habit_id: int):
     """Delete a habit and its logs."""
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM habit_logs WHERE habit_id = $1", habit_id)
+    async with _acquire() as conn:
+        # habit_logs and pending_notifications go with it (ON DELETE CASCADE)
         await conn.execute("DELETE FROM habits WHERE id = $1", habit_id)
 
 
@@ -374,33 +658,31 @@ async def log_habit(habit_id: int, user_id: int, value: float, log_date: date =
     if log_date is None:
         log_date = date.today()
 
-    async with pool.acquire() as conn:
-        # Get habit info
-        habit = await conn.fetchrow("SELECT * FROM habits WHERE id = $1", habit_id)
-        habit = dict(habit)
-
-        # Check if log exists for today
-        existing = await conn.fetchrow(
-            "SELECT * FROM habit_logs WHERE habit_id = $1 AND log_date = $2",
-            habit_id, log_date
+    async with _acquire() as conn:
+        # Read the habit and insert today's log (or add to the existing value)
+        # in one statement. The stored REAL value goes back through numeric so
+        # the user sees 0.1, not its float4 widening 0.10000000149011612.
+        row = await conn.fetchrow(
+            """WITH h AS (SELECT * FROM habits WHERE id = $1),
+                    l AS (
+                        INSERT INTO habit_logs (habit_id, user_id, log_date, value, completed)
+                        SELECT $1, $2, $3, $4::real, CASE WHEN $4::real >= h.daily_goal THEN 1 ELSE 0 END
+                        FROM h
+                        ON CONFLICT (habit_id, log_date) DO UPDATE
+                        SET value = habit_logs.value + EXCLUDED.value,
+                            completed = CASE WHEN habit_logs.value + EXCLUDED.value >= (SELECT daily_goal FROM h)
+                                             THEN 1 ELSE 0 END,
+                            logged_at = NOW()
+                        RETURNING value, completed
+                    )
+               SELECT h.*, l.value::numeric::float8 AS log_value, l.completed AS log_completed
+               FROM h, l""",
+            habit_id, user_id, log_date, value
         )
 
-        if existing:
-            # Update existing log (add to value)
-            new_value = existing['value'] + value
-            completed = 1 if new_value >= habit['daily_goal'] else 0
-            await conn.execute(
-                "UPDATE habit_logs SET value = $1, completed = $2, logged_at = $3 WHERE id = $4",
-                new_value, completed, datetime.now(), existing['id']
-            )
-        else:
-            # Create new log
-            new_value = value
-            completed = 1 if new_value >= habit['daily_goal'] else 0
-            await conn.execute(
-                "INSERT INTO habit_logs (habit_id, user_id, log_date, value, completed) VALUES ($1, $2, $3, $4, $5)",
-                habit_id, user_id, log_date, new_value, completed
-            )
+        habit = dict(row)
+        new_value = habit.pop('log_value')
+        completed = habit.pop('log_completed')
 
         return {
             "habit": habit,
@@ -415,15 +697,15 @@ async def get_daily_log(habit_id: int, log_date: date = None) -> Optional[dict]:
     if log_date is None:
         log_date = date.today()
 
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM habit_logs WHERE habit_id = $1 AND log_date = $2",
+            SQL_GET_DAILY_LOG,
             habit_id, log_date
         )
         return dict(row) if row else None
 
 
-async def get_daily_logs_batch(habit_ids: List[int], log_date: date = None) -> Dict[int, dict]:
+async def get_daily_logs_batch(habit_ids: List[int], log_date: date = None) -> Dict[int, asyncpg.Record]:
     """Get logs for multiple habits at once. Returns dict mapping habit_id -> log."""
     if not habit_ids:
         return {}
@@ -431,12 +713,12 @@ async def get_daily_logs_batch(habit_ids: List[int], log_date: date = None) -> D
     if log_date is None:
         log_date = date.today()
 
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             "SELECT * FROM habit_logs WHERE habit_id = ANY($1) AND log_date = $2",
             habit_ids, log_date
         )
-        return {row['habit_id']: dict(row) for row in rows}
+        return {row['habit_id']: row for row in rows}
 
 
 async def update_log_comment(habit_id: int, comment: str, log_date: date = None):
@@ -444,7 +726,7 @@ async def update_log_comment(habit_id: int, comment: str, log_date: date = None)
     if log_date is None:
         log_date = date.today()
 
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "UPDATE habit_logs SET comment = $1 WHERE habit_id = $2 AND log_date = $3",
             comment, habit_id, log_date
@@ -452,29 +734,34 @@ async def update_log_comment(habit_id: int, comment: str, log_date: date = None)
 
 
 async def get_last_comment(habit_id: int) -> Optional[str]:
-    """Get the last comment for a habit (for backwards compatibility)."""
-    comments = await get_last_comments(habit_id, limit=1)
-    return comments[0]['comment'] if comments else None
+    """Get the last comment for a habit."""
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """SELECT comment FROM habit_logs
+               WHERE habit_id = $1 AND comment IS NOT NULL AND comment != ''
+               ORDER BY log_date DESC LIMIT 1""",
+            habit_id
+        )
 
 
-async def get_last_comments(habit_id: int, limit: int = 3) -> List[dict]:
+async def get_last_comments(habit_id: int, limit: int = 3) -> List[asyncpg.Record]:
     """Get the last N comments for a habit with dates."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT comment, log_date FROM habit_logs
                WHERE habit_id = $1 AND comment IS NOT NULL AND comment != ''
                ORDER BY log_date DESC LIMIT $2""",
             habit_id, limit
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def get_user_daily_logs(user_id: int, log_date: date = None) -> List[dict]:
+async def get_user_daily_logs(user_id: int, log_date: date = None) -> List[asyncpg.Record]:
     """Get all logs for a user on a specific date."""
     if log_date is None:
         log_date = date.today()
 
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT hl.*, h.name, h.habit_type, h.daily_goal, h.unit
                FROM habit_logs hl
@@ -482,49 +769,61 @@ async def get_user_daily_logs(user_id: int, log_date: date = None) -> List[dict]
                WHERE hl.user_id = $1 AND hl.log_date = $2""",
             user_id, log_date
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def get_habit_logs_range(habit_id: int, start_date: date, end_date: date) -> List[dict]:
+async def get_habit_logs_range(habit_id: int, start_date: date, end_date: date) -> List[asyncpg.Record]:
     """Get habit logs for a date range."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT * FROM habit_logs
                WHERE habit_id = $1 AND log_date BETWEEN $2 AND $3
                ORDER BY log_date""",
             habit_id, start_date, end_date
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 # ============ STREAK FUNCTIONS ============
 
-async def update_streak(habit_id: int, completed: bool):
-    """Update streak for a habit after end-of-day check."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT streak, max_streak FROM habits WHERE id = $1", habit_id)
-        current_streak, max_streak = row['streak'], row['max_streak']
+async def update_all_streaks(for_date: date = None) -> Dict[int, tuple]:
+    """Update streaks of all active habits after end-of-day check in one statement.
 
-        if completed:
-            new_streak = current_streak + 1
-            new_max = max(max_streak, new_streak)
-        else:
-            new_streak = 0
-            new_max = max_streak
+    A day counts as done when its logged value (0 if nothing was logged)
+    reaches the habit's current daily_goal, the same rule the end-of-day
+    report uses.
 
-        await conn.execute(
-            "UPDATE habits SET streak = $1, max_streak = $2 WHERE id = $3",
-            new_streak, new_max, habit_id
-        )
+    Returns dict mapping habit_id -> (previous_streak, new_streak).
+    """
+    if for_date is None:
+        for_date = date.today()
 
-        return new_streak, completed
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """WITH prev AS (
+                   SELECT h.id, h.streak,
+                          COALESCE(l.value, 0) >= h.daily_goal AS done
+                   FROM habits h
+                   LEFT JOIN habit_logs l ON l.habit_id = h.id AND l.log_date = $1
+                   WHERE h.is_active = 1
+               )
+               UPDATE habits
+               SET streak = CASE WHEN prev.done THEN habits.streak + 1 ELSE 0 END,
+                   max_streak = CASE WHEN prev.done THEN GREATEST(habits.max_streak, habits.streak + 1)
+                                     ELSE habits.max_streak END
+               FROM prev
+               WHERE habits.id = prev.id
+               RETURNING habits.id, prev.streak AS prev_streak, habits.streak""",
+            for_date
+        )
+        return {row['id']: (row['prev_streak'], row['streak']) for row in rows}
 
 
 # ============ PENDING NOTIFICATION FUNCTIONS ============
 
 async def create_pending_notification(user_id: int, habit_id: int, message_id: int = None, chat_id: int = None):
     """Create a pending notification. Uses PostgreSQL NOW() for consistent timezone handling."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             """INSERT INTO pending_notifications (user_id, habit_id, sent_at, expires_at, message_id, chat_id)
                VALUES ($1, $2, NOW(), NOW() + INTERVAL '10 minutes', $3, $4)""",
@@ -534,7 +833,7 @@ async def create_pending_notification(user_id: int, habit_id: int, message_id: i
 
 async def mark_notification_responded(user_id: int, habit_id: int):
     """Mark pending notification as responded."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             """UPDATE pending_notifications SET responded = 1
                WHERE user_id = $1 AND habit_id = $2 AND responded = 0""",
@@ -542,27 +841,26 @@ async def mark_notification_responded(user_id: int, habit_id: int):
         )
 
 
-async def get_expired_notifications() -> List[dict]:
-    """Get all expired pending notifications that weren't responded."""
-    async with pool.acquire() as conn:
+async def pop_expired_notifications() -> List[asyncpg.Record]:
+    """Delete and return all expired pending notifications that weren't responded."""
+    async with _acquire() as conn:
         rows = await conn.fetch(
-            """SELECT * FROM pending_notifications
-               WHERE responded = 0 AND expires_at < NOW()"""
+            """DELETE FROM pending_notifications
+               WHERE responded = 0 AND expires_at < NOW()
+               RETURNING *"""
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def delete_expired_notifications():
-    """Delete processed expired notifications."""
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "DELETE FROM pending_notifications WHERE responded = 1 OR expires_at < NOW()"
-        )
+async def delete_responded_notifications():
+    """Delete notifications that were already responded to."""
+    async with _acquire() as conn:
+        await conn.execute("DELETE FROM pending_notifications WHERE responded = 1")
 
 
 async def get_notification_for_deletion(user_id: int) -> Optional[dict]:
     """Get pending notification for user to delete the message."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """SELECT message_id, chat_id FROM pending_notifications
                WHERE user_id = $1 AND responded = 0
@@ -582,7 +880,7 @@ async def create_marathon(
     invite_code: str
 ) -> int:
     """Create a new marathon."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """INSERT INTO marathons (creator_id, name, start_date, end_date, invite_code)
                VALUES ($1, $2, $3, $4, $5) RETURNING id""",
@@ -599,26 +897,23 @@ async def create_marathon(
         return marathon_id
 
 
-async def add_marathon_habit(
-    marathon_id: int,
-    name: str,
-    habit_type: str,
-    daily_goal: float = 1,
-    unit: str = "",
-    points_per_goal: float = 1
-):
-    """Add a habit template to marathon."""
-    async with pool.acquire() as conn:
-        await conn.execute(
+async def add_marathon_habits(marathon_id: int, habits: List[dict]):
+    """Add several habit templates to marathon in one batch."""
+    async with _acquire() as conn:
+        await conn.executemany(
             """INSERT INTO marathon_habits (marathon_id, name, habit_type, daily_goal, unit, points_per_goal)
                VALUES ($1, $2, $3, $4, $5, $6)""",
-            marathon_id, name, habit_type, daily_goal, unit, points_per_goal
+            [
+                (marathon_id, h['name'], h['habit_type'], h.get('daily_goal', 1),
+                 h.get('unit', ''), h.get('points_per_goal', 1))
+                for h in habits
+            ]
         )
 
 
 async def get_marathon_by_code(invite_code: str) -> Optional[dict]:
     """Get marathon by invite code."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM marathons WHERE invite_code = $1", invite_code
         )
@@ -627,32 +922,24 @@ async def get_marathon_by_code(invite_code: str) -> Optional[dict]:
 
 async def join_marathon(user_id: int, marathon_id: int):
     """Join a marathon and copy its habits."""
-    async with pool.acquire() as conn:
-        # Check if already joined
-        existing = await conn.fetchrow(
-            "SELECT * FROM marathon_participants WHERE marathon_id = $1 AND user_id = $2",
-            marathon_id, user_id
-        )
-        if existing:
-            return False
-
-        # Add participant
-        await conn.execute(
-            "INSERT INTO marathon_participants (marathon_id, user_id) VALUES ($1, $2)",
-            marathon_id, user_id
-        )
-
-        # Copy marathon habits to user
-        habits = await conn.fetch(
-            "SELECT * FROM marathon_habits WHERE marathon_id = $1", marathon_id
-        )
+    async with _acquire() as conn:
+        async with conn.transaction():
+            # Add participant (nothing is inserted if already joined)
+            joined = await conn.fetchval(
+                """INSERT INTO marathon_participants (marathon_id, user_id) VALUES ($1, $2)
+                   ON CONFLICT (marathon_id, user_id) DO NOTHING
+                   RETURNING id""",
+                marathon_id, user_id
+            )
+            if joined is None:
+                return False
 
-        for habit in habits:
+            # Copy marathon habits to user
             await conn.execute(
                 """INSERT INTO habits (user_id, name, habit_type, daily_goal, unit, marathon_id)
-                   VALUES ($1, $2, $3, $4, $5, $6)""",
-                user_id, habit['name'], habit['habit_type'], habit['daily_goal'],
-                habit['unit'], marathon_id
+                   SELECT $1, name, habit_type, daily_goal, unit, marathon_id
+                   FROM marathon_habits WHERE marathon_id = $2""",
+                user_id, marathon_id
             )
 
         return True
@@ -660,9 +947,9 @@ async def join_marathon(user_id: int, marathon_id: int):
 
 async def get_marathon_leaderboard(marathon_id: int) -> List[dict]:
     """Get marathon leaderboard."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
-            """SELECT mp.*, u.first_name, u.username
+            """SELECT mp.user_id, mp.total_points, u.first_name, u.username
                FROM marathon_participants mp
                JOIN users u ON mp.user_id = u.user_id
                WHERE mp.marathon_id = $1
@@ -672,76 +959,84 @@ async def get_marathon_leaderboard(marathon_id: int) -> List[dict]:
         return [dict(row) for row in rows]
 
 
-async def update_marathon_points(user_id: int, marathon_id: int, points: float):
-    """Add points to user in marathon."""
-    async with pool.acquire() as conn:
+async def award_marathon_points(for_date: date = None):
+    """Give every participant 1 point per marathon habit completed on for_date, in one statement.
+
+    Completion uses the same rule as update_all_streaks(): the day's value
+    (0 if nothing was logged) >= daily_goal.
+    """
+    if for_date is None:
+        for_date = date.today()
+
+    async with _acquire() as conn:
         await conn.execute(
-            """UPDATE marathon_participants
-               SET total_points = total_points + $1
-               WHERE user_id = $2 AND marathon_id = $3""",
-            points, user_id, marathon_id
+            """UPDATE marathon_participants p
+               SET total_points = p.total_points + d.points
+               FROM (
+                   SELECT h.user_id, h.marathon_id, COUNT(*) AS points
+                   FROM habits h
+                   LEFT JOIN habit_logs l ON l.habit_id = h.id AND l.log_date = $1
+                   WHERE h.is_active = 1 AND h.marathon_id IS NOT NULL
+                     AND COALESCE(l.value, 0) >= h.daily_goal
+                   GROUP BY h.user_id, h.marathon_id
+               ) d
+               WHERE p.user_id = d.user_id AND p.marathon_id = d.marathon_id""",
+            for_date
         )
 
 
-async def get_user_marathons(user_id: int) -> List[dict]:
+async def get_user_marathons(user_id: int) -> List[asyncpg.Record]:
     """Get all marathons user is participating in."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
-            """SELECT m.* FROM marathons m
+            """SELECT m.id, m.name, m.start_date, m.end_date FROM marathons m
                JOIN marathon_participants mp ON m.id = mp.marathon_id
                WHERE mp.user_id = $1 AND m.is_active = 1
                ORDER BY m.start_date""",
             user_id
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
-async def get_active_marathons_today() -> List[dict]:
+async def get_active_marathons_today() -> List[asyncpg.Record]:
     """Get marathons that are active today."""
     today = date.today()
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT * FROM marathons
                WHERE is_active = 1 AND start_date <= $1 AND end_date >= $1""",
             today
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 async def leave_marathon(user_id: int, marathon_id: int, keep_habits: bool = False):
     """Leave a marathon and optionally keep or delete habits."""
-    async with pool.acquire() as conn:
-        # Remove from participants
-        await conn.execute(
-            "DELETE FROM marathon_participants WHERE user_id = $1 AND marathon_id = $2",
-            user_id, marathon_id
-        )
-
-        if keep_habits:
-            # Unlink habits from marathon (keep them as personal)
+    async with _acquire() as conn:
+        async with conn.transaction():
+            # Remove from participants
             await conn.execute(
-                "UPDATE habits SET marathon_id = NULL WHERE user_id = $1 AND marathon_id = $2",
-                user_id, marathon_id
-            )
-        else:
-            # Delete marathon habits and their logs
-            habits = await conn.fetch(
-                "SELECT id FROM habits WHERE user_id = $1 AND marathon_id = $2",
+                "DELETE FROM marathon_participants WHERE user_id = $1 AND marathon_id = $2",
                 user_id, marathon_id
             )
 
-            for habit in habits:
-                await conn.execute("DELETE FROM habit_logs WHERE habit_id = $1", habit['id'])
-
-            await conn.execute(
-                "DELETE FROM habits WHERE user_id = $1 AND marathon_id = $2",
-                user_id, marathon_id
-            )
+            if keep_habits:
+                # Unlink habits from marathon (keep them as personal)
+                await conn.execute(
+                    "UPDATE habits SET marathon_id = NULL WHERE user_id = $1 AND marathon_id = $2",
+                    user_id, marathon_id
+                )
+            else:
+                # Delete marathon habits; their logs cascade
+                await conn.execute(
+                    "DELETE FROM habits WHERE user_id = $1 AND marathon_id = $2",
+                    user_id, marathon_id
+                )
 
 
 async def get_marathon_by_id(marathon_id: int) -> Optional[dict]:
     """Get marathon by ID."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM marathons WHERE id = $1", marathon_id
         )
@@ -750,7 +1045,7 @@ async def get_marathon_by_id(marathon_id: int) -> Optional[dict]:
 
 async def get_marathon_participant_info(marathon_id: int, user_id: int) -> Optional[dict]:
     """Get detailed info about marathon participant."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """SELECT u.first_name, u.username, mp.total_points, mp.joined_at
                FROM users u
@@ -761,123 +1056,194 @@ async def get_marathon_participant_info(marathon_id: int, user_id: int) -> Optio
         return dict(row) if row else None
 
 
-async def get_user_marathon_habits(user_id: int, marathon_id: int) -> List[dict]:
+async def get_user_marathon_habits(user_id: int, marathon_id: int) -> List[asyncpg.Record]:
     """Get user's habits for a specific marathon."""
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT name, daily_goal, unit, streak
                FROM habits
                WHERE user_id = $1 AND marathon_id = $2""",
             user_id, marathon_id
         )
-        return [dict(row) for row in rows]
+        return rows
 
 
 # ============ ANALYTICS FUNCTIONS ============
 
-async def get_habit_stats(habit_id: int, start_date: date, end_date: date) -> dict:
-    """Get detailed statistics for a habit over a period."""
-    async with pool.acquire() as conn:
+def _build_stats(habit: dict, total_days: int, completed: int, total_value: float,
+                 best_day: Optional[dict]) -> dict:
+    """Shape a habit's aggregates for a period into its stats dict."""
+    if habit['habit_type'] == 'boolean':
+        return {
+            "habit": habit,
+            "total_days": total_days,
+            "completed_days": completed,
+            "missed_days": total_days - completed,
+            "efficiency": round(completed / total_days * 100, 1) if total_days > 0 else 0
+        }
+
+    return {
+        "habit": habit,
+        "total_days": total_days,
+        "total_value": total_value,
+        "average": round(total_value / total_days, 2) if total_days > 0 else 0,
+        "best_day": best_day,
+        "completed_days": completed
+    }
+
+
+async def get_habit_stats(habit_id: int, start_date: date, end_date: date,
+                          include_logs: bool = False) -> dict:
+    """Get detailed statistics for a habit over a period.
+
+    Totals are aggregated in PostgreSQL; the per-day logs (for charts) are
+    only fetched when include_logs is set.
+    """
+    async with _acquire() as conn:
         # Get habit info
-        habit = await conn.fetchrow("SELECT * FROM habits WHERE id = $1", habit_id)
+        habit = await conn.fetchrow(SQL_GET_HABIT, habit_id)
         habit = dict(habit)
 
-        # Get logs
-        rows = await conn.fetch(
-            """SELECT * FROM habit_logs
-               WHERE habit_id = $1 AND log_date BETWEEN $2 AND $3
-               ORDER BY log_date""",
+        # Aggregate the period, plus its best day (earliest on ties)
+        summary = await conn.fetchrow(
+            """SELECT s.completed_days, s.total_value, b.log_date, b.value
+               FROM (SELECT COUNT(*) FILTER (WHERE completed = 1) AS completed_days,
+                            SUM(value) AS total_value
+                     FROM habit_logs
+                     WHERE habit_id = $1 AND log_date BETWEEN $2 AND $3) s
+               LEFT JOIN LATERAL (
+                   SELECT log_date, value FROM habit_logs
+                   WHERE habit_id = $1 AND log_date BETWEEN $2 AND $3
+                   ORDER BY value DESC, log_date
+                   LIMIT 1
+               ) b ON TRUE""",
             habit_id, start_date, end_date
         )
-        logs = [dict(row) for row in rows]
-
-        # Calculate days in period
-        total_days = (end_date - start_date).days + 1
-
-        if habit['habit_type'] == 'boolean':
-            completed = sum(1 for log in logs if log['completed'])
-            return {
-                "habit": habit,
-                "total_days": total_days,
-                "completed_days": completed,
-                "missed_days": total_days - completed,
-                "efficiency": round(completed / total_days * 100, 1) if total_days > 0 else 0,
-                "logs": logs
-            }
-        else:
-            total_value = sum(log['value'] for log in logs)
-            best_day = max(logs, key=lambda x: x['value']) if logs else None
 
-            return {
-                "habit": habit,
-                "total_days": total_days,
-                "total_value": total_value,
-                "average": round(total_value / total_days, 2) if total_days > 0 else 0,
-                "best_day": best_day,
-                "completed_days": sum(1 for log in logs if log['completed']),
-                "logs": logs
-            }
+        logs = None
+        if include_logs:
+            rows = await conn.fetch(
+                """SELECT * FROM habit_logs
+                   WHERE habit_id = $1 AND log_date BETWEEN $2 AND $3
+                   ORDER BY log_date""",
+                habit_id, start_date, end_date
+            )
+            logs = [dict(row) for row in rows]
+
+    best_day = None
+    if summary['log_date'] is not None:
+        best_day = {"log_date": summary['log_date'], "value": summary['value']}
+
+    stats = _build_stats(
+        habit,
+        (end_date - start_date).days + 1,
+        summary['completed_days'],
+        summary['total_value'] or 0,
+        best_day
+    )
+
+    if include_logs:
+        stats["logs"] = logs
+    return stats
+
+
+async def get_user_habits_stats(user_id: int, start_date: date, end_date: date) -> List[dict]:
+    """Get get_habit_stats() results for all of a user's active habits in one query."""
+    total_days = (end_date - start_date).days + 1
+
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT h.*, s.completed_days, s.total_value,
+                      b.log_date AS best_log_date, b.value AS best_value
+               FROM habits h
+               CROSS JOIN LATERAL (
+                   SELECT COUNT(*) FILTER (WHERE completed = 1) AS completed_days,
+                          COALESCE(SUM(value), 0) AS total_value
+                   FROM habit_logs
+                   WHERE habit_id = h.id AND log_date BETWEEN $2 AND $3
+               ) s
+               LEFT JOIN LATERAL (
+                   SELECT log_date, value FROM habit_logs
+                   WHERE habit_id = h.id AND log_date BETWEEN $2 AND $3
+                   ORDER BY value DESC, log_date
+                   LIMIT 1
+               ) b ON TRUE
+               WHERE h.user_id = $1 AND h.is_active = 1
+               ORDER BY h.category_id, h.name""",
+            user_id, start_date, end_date
+        )
+
+    all_stats = []
+    for row in rows:
+        habit = dict(row)
+        completed = habit.pop('completed_days')
+        total_value = habit.pop('total_value')
+        best_log_date = habit.pop('best_log_date')
+        best_value = habit.pop('best_value')
+
+        best_day = None
+        if best_log_date is not None:
+            best_day = {"log_date": best_log_date, "value": best_value}
+
+        all_stats.append(_build_stats(habit, total_days, completed, total_value, best_day))
+
+    return all_stats
 
 
 async def get_weekly_report(user_id: int, week_start: date) -> dict:
     """Generate weekly report."""
-    from datetime import timedelta
     week_end = week_start + timedelta(days=6)
 
-    habits = await get_user_habits(user_id)
-    report = {
+    return {
         "period": f"{week_start} - {week_end}",
-        "habits": []
+        "habits": await get_user_habits_stats(user_id, week_start, week_end)
     }
 
-    for habit in habits:
-        stats = await get_habit_stats(habit['id'], week_start, week_end)
-        report["habits"].append(stats)
 
-    return report
+# ============ Admin Functions ============
 
+async def iter_all_user_ids(batch_size: int = 500) -> AsyncIterator[int]:
+    """Yield all user IDs for broadcasting, fetched in keyset-paginated batches.
+
+    The connection goes back to the pool between batches, so a slow,
+    throttled broadcast doesn't hold one for its whole run. Batches always
+    come straight from the pool, never from a request_connection() block.
+    """
+    last_id = None
+    while True:
+        async with pool.acquire() as conn:
+            if last_id is None:
+                rows = await conn.fetch(
+                    "SELECT user_id FROM users ORDER BY user_id LIMIT $1", batch_size
+                )
+            else:
+                rows = await conn.fetch(
+                    "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                    last_id, batch_size
+                )
+        for row in rows:
+            yield row[0]
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
 
-# ============ Admin Functions ============
 
-async def get_all_user_ids() -> List[int]:
-    """Get all user IDs for broadcasting."""
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM users")
-        return [row['user_id'] for row in rows]
+async def get_user_count() -> int:
+    """Get total number of users."""
+    async with _acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM users")
 
 
 async def get_admin_stats() -> dict:
     """Get statistics for admin panel."""
-    async with pool.acquire() as conn:
-        # Total users
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-
-        # Users today
-        users_today = await conn.fetchval(
-            "SELECT COUNT(*) FROM users WHERE DATE(created_at) = CURRENT_DATE"
-        )
-
-        # Total habits
-        total_habits = await conn.fetchval("SELECT COUNT(*) FROM habits WHERE is_active = 1")
-
-        # Total marathons
-        total_marathons = await conn.fetchval("SELECT COUNT(*) FROM marathons")
-
-        # Active marathons
-        active_marathons = await conn.fetchval(
-            "SELECT COUNT(*) FROM marathons WHERE end_date >= CURRENT_DATE"
-        )
-
-        # Total logs today
-        logs_today = await conn.fetchval(
-            "SELECT COUNT(*) FROM habit_logs WHERE DATE(logged_at) = CURRENT_DATE"
-        )
-
-        return {
-            "total_users": total_users,
-            "users_today": users_today,
-            "total_habits": total_habits,
-            "total_marathons": total_marathons,
-            "active_marathons": active_marathons,
-            "logs_today": logs_today
-        }
+    async with _acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                (SELECT COUNT(*) FROM users WHERE created_at >= CURRENT_DATE) AS users_today,
+                (SELECT COUNT(*) FROM habits WHERE is_active = 1) AS total_habits,
+                (SELECT COUNT(*) FROM marathons) AS total_marathons,
+                (SELECT COUNT(*) FROM marathons WHERE end_date >= CURRENT_DATE) AS active_marathons,
+                (SELECT COUNT(*) FROM habit_logs WHERE logged_at >= CURRENT_DATE) AS logs_today
+        """)
+        return dict(row)
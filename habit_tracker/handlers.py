@@ -184,12 +184,10 @@ async def cancel_input(callback: CallbackQuery, state: FSMContext):
 @router.message(F.text.in_({"📝 Мои привычки", "📝 Менің әдеттерім"}))
 async def show_habits(message: Message):
     """Show categories first, then habits when category is selected."""
-    lang = await db.get_user_language(message.from_user.id)
-    habits = await db.get_user_habits(message.from_user.id)
-    categories = await db.get_user_categories(message.from_user.id)
-
-    # Add completion status for today (batch query)
-    await add_completion_status(habits)
+    async with db.request_connection():
+        lang = await db.get_user_language(message.from_user.id)
+        habits = await db.get_user_habits_with_today_log(message.from_user.id)
+        categories = await db.get_user_categories(message.from_user.id)
 
     if not habits:
         text = get_text("no_habits", lang)
@@ -215,13 +213,10 @@ async def show_habits(message: Message):
 async def back_to_habits(callback: CallbackQuery, state: FSMContext):
     """Return to categories list (habits filter)."""
     await state.clear()
-    lang = await db.get_user_language(callback.from_user.id)
-
-    habits = await db.get_user_habits(callback.from_user.id)
-    categories = await db.get_user_categories(callback.from_user.id)
-
-    # Add completion status (batch query)
-    await add_completion_status(habits)
+    async with db.request_connection():
+        lang = await db.get_user_language(callback.from_user.id)
+        habits = await db.get_user_habits_with_today_log(callback.from_user.id)
+        categories = await db.get_user_categories(callback.from_user.id)
 
     text = get_text("your_habits_short", lang)
     text += "\n\n"
@@ -407,15 +402,18 @@ async def habit_category_selected(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("habit_view_"))
 async def view_habit(callback: CallbackQuery):
     """View habit details."""
-    lang = await db.get_user_language(callback.from_user.id)
     habit_id = int(callback.data.split("_")[2])
-    habit = await db.get_habit(habit_id)
+    async with db.request_connection():
+        lang = await db.get_user_language(callback.from_user.id)
+        habit = await db.get_habit(habit_id)
+        if habit:
+            log = await db.get_daily_log(habit_id)
+            last_comments = await db.get_last_comments(habit_id, limit=3)
 
     if not habit:
         await callback.answer(get_text("habit_not_found", lang), show_alert=True)
         return
 
-    log = await db.get_daily_log(habit_id)
     today_value = log['value'] if log else 0
 
     if habit['habit_type'] == 'boolean':
@@ -430,7 +428,6 @@ async def view_habit(callback: CallbackQuery):
         text += get_text("today_label", lang, value=f"{today_value}/{habit['daily_goal']} {habit['unit']}") + "\n"
 
     # Show last 3 comments
-    last_comments = await db.get_last_comments(habit_id, limit=3)
     if last_comments:
         text += "\n" + get_text("notes_label", lang) + "\n"
         for c in last_comments:
@@ -608,10 +605,7 @@ async def edit_habit_goal_done(message: Message, state: FSMContext):
 async def quick_log_menu(message: Message):
     """Show habits for quick logging."""
     lang = await db.get_user_language(message.from_user.id)
-    habits = await db.get_user_habits(message.from_user.id)
-
-    # Add completion status (batch query)
-    await add_completion_status(habits)
+    habits = await db.get_user_habits_with_today_log(message.from_user.id)
 
     if not habits:
         await message.answer(get_text("no_habits", lang))
@@ -1501,7 +1495,7 @@ async def generate_and_send_stats(callback: CallbackQuery, state: FSMContext,
 
     if habit_id:
         # Single habit stats
-        stats = await db.get_habit_stats(habit_id, start_date, end_date)
+        stats = await db.get_habit_stats(habit_id, start_date, end_date, include_logs=True)
         habit = stats['habit']
 
         days = (end_date - start_date).days + 1
@@ -1526,16 +1520,16 @@ async def generate_and_send_stats(callback: CallbackQuery, state: FSMContext,
             chart = await analytics.generate_habit_report_chart_async(stats)
             if chart:
                 await callback.message.answer_photo(
-                    BufferedInputFile(chart.read(), filename="stats.png")
+                    BufferedInputFile(chart, filename="stats.jpg")
                 )
     else:
         # All habits summary
-        habits = await db.get_user_habits(callback.from_user.id)
+        all_stats = await db.get_user_habits_stats(callback.from_user.id, start_date, end_date)
+        habits = [stats['habit'] for stats in all_stats]
         text = f"📊 **Общая статистика**\n"
         text += f"Период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
 
-        for habit in habits:
-            stats = await db.get_habit_stats(habit['id'], start_date, end_date)
+        for habit, stats in zip(habits, all_stats):
             if habit['habit_type'] == 'boolean':
                 text += f"• **{habit['name']}**: {stats['efficiency']}% ({stats['completed_days']} дней)\n"
             else:
@@ -1547,7 +1541,7 @@ async def generate_and_send_stats(callback: CallbackQuery, state: FSMContext,
         if habits:
             chart = await analytics.create_streak_chart_async(habits)
             await callback.message.answer_photo(
-                BufferedInputFile(chart.read(), filename="streaks.png")
+                BufferedInputFile(chart, filename="streaks.jpg")
             )
 
     await state.clear()
@@ -1845,14 +1839,7 @@ async def finalize_marathon(message: Message, state: FSMContext):
     )
 
     # Add habits to marathon
-    for habit in habits:
-        await db.add_marathon_habit(
-            marathon_id=marathon_id,
-            name=habit['name'],
-            habit_type=habit['habit_type'],
-            daily_goal=habit['daily_goal'],
-            unit=habit.get('unit', '')
-        )
+    await db.add_marathon_habits(marathon_id, habits)
 
     # Copy habits to creator
     for habit in habits:
@@ -1904,14 +1891,7 @@ async def finalize_marathon_from_callback(callback: CallbackQuery, state: FSMCon
     )
 
     # Add habits to marathon
-    for habit in habits:
-        await db.add_marathon_habit(
-            marathon_id=marathon_id,
-            name=habit['name'],
-            habit_type=habit['habit_type'],
-            daily_goal=habit['daily_goal'],
-            unit=habit.get('unit', '')
-        )
+    await db.add_marathon_habits(marathon_id, habits)
 
     # Copy habits to creator
     for habit in habits:
@@ -1995,7 +1975,7 @@ async def show_leaderboard(callback: CallbackQuery):
     if participants:
         chart = await analytics.generate_leaderboard_chart_async(participants)
         await callback.message.answer_photo(
-            BufferedInputFile(chart.read(), filename="leaderboard.png")
+            BufferedInputFile(chart, filename="leaderboard.jpg")
         )
 
     await callback.answer()
@@ -2298,15 +2278,12 @@ async def test_notification(message: Message):
 
     from scheduler import send_habit_notification
 
-    habits = await db.get_user_habits(message.from_user.id)
+    habits = await db.get_user_habits_with_today_log(message.from_user.id)
 
     if not habits:
         await message.answer("У тебя нет привычек для тестирования")
         return
 
-    # Get all logs at once (batch query)
-    await add_completion_status(habits)
-
     await message.answer(f"🧪 Отправляю тестовые уведомления для {len(habits)} привычек...")
 
     for habit in habits:
@@ -2350,13 +2327,13 @@ async def admin_broadcast_send(message: Message, state: FSMContext):
 
     await state.clear()
 
-    user_ids = await db.get_all_user_ids()
+    total = await db.get_user_count()
     success = 0
     failed = 0
 
-    status_msg = await message.answer(f"📨 Начинаю рассылку... 0/{len(user_ids)}")
+    status_msg = await message.answer(f"📨 Начинаю рассылку... 0/{total}")
 
-    for i, user_id in enumerate(user_ids):
+    async for user_id in db.iter_all_user_ids():
         try:
             await message.bot.send_message(
                 user_id,
@@ -2368,9 +2345,10 @@ async def admin_broadcast_send(message: Message, state: FSMContext):
             failed += 1
 
         # Update status every 10 users
-        if (i + 1) % 10 == 0:
+        done = success + failed
+        if done % 10 == 0:
             try:
-                await status_msg.edit_text(f"📨 Рассылка... {i + 1}/{len(user_ids)}")
+                await status_msg.edit_text(f"📨 Рассылка... {done}/{total}")
             except Exception:
                 pass
 
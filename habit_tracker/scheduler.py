@@ -21,6 +21,38 @@ def set_bot(bot):
     bot_instance = bot
 
 
+# Scheduled jobs handle up to USER_CONCURRENCY users at once, each on at most
+# one pooled connection, leaving the other half of the pool to handlers.
+# Each send holds one of SENDS_PER_SECOND slots for at least a second, which
+# keeps the bot under Telegram's limit of ~30 messages per second.
+USER_CONCURRENCY = db.POOL_MAX_SIZE // 2
+SENDS_PER_SECOND = 20
+_send_slots = asyncio.Semaphore(SENDS_PER_SECOND)
+
+
+async def _send_message(chat_id: int, text: str, **kwargs):
+    """Send a message from a scheduled job, rate-limited."""
+    async with _send_slots:
+        msg, _ = await asyncio.gather(
+            bot_instance.send_message(chat_id, text, **kwargs),
+            asyncio.sleep(1)
+        )
+    return msg
+
+
+async def _for_each_user(users: list, process_user):
+    """Run process_user(user) for every user, USER_CONCURRENCY at a time."""
+    semaphore = asyncio.Semaphore(USER_CONCURRENCY)
+
+    async def run(user):
+        async with semaphore:
+            await process_user(user)
+
+    # process_user handles its own errors; this just keeps one failure from
+    # cancelling the rest of the run
+    await asyncio.gather(*(run(user) for user in users), return_exceptions=True)
+
+
 async def send_consolidated_notification(user_id: int, uncompleted_habits: list):
     """Send ONE notification with all uncompleted habits."""
     if not bot_instance or not uncompleted_habits:
@@ -45,7 +77,7 @@ async def send_consolidated_notification(user_id: int, uncompleted_habits: list)
         # Use log_habits_keyboard to show all habits
         keyboard = log_habits_keyboard(uncompleted_habits, lang)
 
-        msg = await bot_instance.send_message(
+        msg = await _send_message(
             user_id,
             text,
             reply_markup=keyboard,
@@ -62,33 +94,19 @@ async def send_consolidated_notification(user_id: int, uncompleted_habits: list)
 
 async def check_notifications_for_time(check_time: str):
     """Check all users who need notifications at this time."""
-    users = await db.get_all_users()
+    # Uncompleted habits of the users due at check_time (one query)
+    due = await db.get_uncompleted_habits_due_at(check_time)
 
-    for user in users:
-        user_times = await db.get_user_notification_times(user['user_id'])
+    async def _process_user(user_id):
+        # Send ONE notification with all uncompleted habits
+        await send_consolidated_notification(user_id, due[user_id])
 
-        if check_time in user_times:
-            habits = await db.get_user_habits(user['user_id'])
-
-            if not habits:
-                continue
-
-            # Get all logs at once (batch query)
-            habit_ids = [h['id'] for h in habits]
-            logs = await db.get_daily_logs_batch(habit_ids)
-
-            # Collect uncompleted habits
-            uncompleted = [h for h in habits if not logs.get(h['id'], {}).get('completed')]
-
-            # Send ONE notification with all uncompleted habits
-            if uncompleted:
-                await send_consolidated_notification(user['user_id'], uncompleted)
-                await asyncio.sleep(0.1)
+    await _for_each_user(list(due), _process_user)
 
 
 async def check_expired_notifications():
     """Check for expired notifications and delete messages."""
-    expired = await db.get_expired_notifications()
+    expired = await db.pop_expired_notifications()
 
     for notif in expired:
         try:
@@ -100,23 +118,15 @@ async def check_expired_notifications():
                     pass  # Message may already be deleted
 
             # Log zero for ALL uncompleted habits of this user
-            habits = await db.get_user_habits(notif['user_id'])
-
-            if habits:
-                # Get all logs at once (batch query)
-                habit_ids = [h['id'] for h in habits]
-                logs = await db.get_daily_logs_batch(habit_ids)
+            habits = await db.get_user_habits_with_today_log(notif['user_id'])
 
-                for habit in habits:
-                    log = logs.get(habit['id'])
-                    if not log or not log['completed']:
-                        await db.log_habit(habit['id'], notif['user_id'], 0)
+            for habit in habits:
+                if not habit['completed_today']:
+                    await db.log_habit(habit['id'], notif['user_id'], 0)
 
         except Exception as e:
             print(f"Error processing expired notification: {e}")
 
-    await db.delete_expired_notifications()
-
 
 async def process_end_of_day():
     """Process end of day at 23:59 - calculate streaks and send reports."""
@@ -126,31 +136,34 @@ async def process_end_of_day():
     users = await db.get_all_users()
     today = date.today()
 
-    for user in users:
+    # Roll every streak forward and award marathon points (one statement each)
+    # before building the reports
+    streaks = await db.update_all_streaks(today)
+    await db.award_marathon_points(today)
+
+    async def _process_user(user):
         try:
-            lang = await db.get_user_language(user['user_id'])
-            habits = await db.get_user_habits(user['user_id'])
+            # Both reads on one pooled connection, released before sending
+            async with db.request_connection():
+                lang = await db.get_user_language(user['user_id'])
+                habits = await db.get_user_habits_with_today_log(user['user_id'], today)
             if not habits:
-                continue
-
-            # Get all logs at once (batch query)
-            habit_ids = [h['id'] for h in habits]
-            logs = await db.get_daily_logs_batch(habit_ids, today)
+                return
 
             report_lines = [get_text("end_of_day_title", lang) + "\n"]
             streak_updates = []
+            done_label = get_text("done_label", lang)
+            not_done_label = get_text("not_done_label", lang)
 
             for habit in habits:
-                log = logs.get(habit['id'])
-                value = log['value'] if log else 0
+                value = habit['today_value']
                 goal = habit['daily_goal']
                 completed = value >= goal
 
-                # Update streak
-                new_streak, _ = await db.update_streak(habit['id'], completed)
+                prev_streak, new_streak = streaks.get(habit['id'], (habit['streak'], habit['streak']))
 
                 if habit['habit_type'] == 'boolean':
-                    status = get_text("done_label", lang) if completed else get_text("not_done_label", lang)
+                    status = done_label if completed else not_done_label
                     report_lines.append(f"• {habit['name']}: {status}")
                 else:
                     unit = habit.get('unit', '')
@@ -160,23 +173,15 @@ async def process_end_of_day():
                 # Streak message
                 if completed and new_streak > 1:
                     streak_updates.append(get_text("streak_fire", lang, name=habit['name'], streak=new_streak))
-                elif not completed and habit['streak'] > 0:
+                elif not completed and prev_streak > 0:
                     streak_updates.append(get_text("streak_lost", lang, name=habit['name']))
 
-                # Update marathon points if applicable
-                if habit.get('marathon_id') and completed:
-                    await db.update_marathon_points(
-                        user['user_id'],
-                        habit['marathon_id'],
-                        1  # 1 point per completed goal
-                    )
-
             report_text = "\n".join(report_lines)
 
             if streak_updates:
                 report_text += "\n\n" + "\n".join(streak_updates)
 
-            await bot_instance.send_message(
+            await _send_message(
                 user['user_id'],
                 report_text,
                 parse_mode="Markdown"
@@ -185,6 +190,8 @@ async def process_end_of_day():
         except Exception as e:
             print(f"Error processing end of day for user {user['user_id']}: {e}")
 
+    await _for_each_user(users, _process_user)
+
 
 async def send_weekly_report():
     """Send weekly report every Sunday."""
@@ -195,13 +202,14 @@ async def send_weekly_report():
     today = date.today()
     week_start = today - timedelta(days=6)
 
-    for user in users:
+    async def _process_user(user):
         try:
-            lang = await db.get_user_language(user['user_id'])
-            report = await db.get_weekly_report(user['user_id'], week_start)
+            async with db.request_connection():
+                lang = await db.get_user_language(user['user_id'])
+                report = await db.get_weekly_report(user['user_id'], week_start)
 
             if not report['habits']:
-                continue
+                return
 
             text = get_text("weekly_report_title", lang) + "\n"
             text += f"({week_start.strftime('%d.%m')} - {today.strftime('%d.%m')})\n\n"
@@ -215,11 +223,13 @@ async def send_weekly_report():
                     text += f"• {habit['name']}: {habit_stats['total_value']} {habit.get('unit', '')}\n"
                     text += f"  " + get_text("average_per_day", lang, avg=habit_stats['average']) + "\n"
 
-            await bot_instance.send_message(user['user_id'], text, parse_mode="Markdown")
+            await _send_message(user['user_id'], text, parse_mode="Markdown")
 
         except Exception as e:
             print(f"Error sending weekly report to {user['user_id']}: {e}")
 
+    await _for_each_user(users, _process_user)
+
 
 async def send_monthly_report():
     """Send monthly report on 1st of each month."""
@@ -234,25 +244,23 @@ async def send_monthly_report():
     last_of_prev_month = first_of_this_month - timedelta(days=1)
     first_of_prev_month = last_of_prev_month.replace(day=1)
 
-    for user in users:
+    async def _process_user(user):
         try:
-            lang = await db.get_user_language(user['user_id'])
-            habits = await db.get_user_habits(user['user_id'])
+            async with db.request_connection():
+                lang = await db.get_user_language(user['user_id'])
+                all_stats = await db.get_user_habits_stats(
+                    user['user_id'], first_of_prev_month, last_of_prev_month
+                )
 
-            if not habits:
-                continue
+            if not all_stats:
+                return
 
             months_genitive = get_text("months_genitive", lang)
             month_name = months_genitive[last_of_prev_month.month - 1]
             text = get_text("monthly_report_title", lang, month=month_name) + "\n\n"
 
-            for habit in habits:
-                stats = await db.get_habit_stats(
-                    habit['id'],
-                    first_of_prev_month,
-                    last_of_prev_month
-                )
-
+            for stats in all_stats:
+                habit = stats['habit']
                 if habit['habit_type'] == 'boolean':
                     text += f"**{habit['name']}**\n"
                     text += get_text("completed_out_of", lang, completed=stats['completed_days'], total=stats['total_days']) + "\n"
@@ -266,11 +274,13 @@ async def send_monthly_report():
                         text += get_text("best_day_stat", lang, value=stats['best_day']['value'], date=best_date) + "\n"
                     text += "\n"
 
-            await bot_instance.send_message(user['user_id'], text, parse_mode="Markdown")
+            await _send_message(user['user_id'], text, parse_mode="Markdown")
 
         except Exception as e:
             print(f"Error sending monthly report to {user['user_id']}: {e}")
 
+    await _for_each_user(users, _process_user)
+
 
 def setup_scheduler():
     """Setup all scheduled jobs."""
@@ -294,6 +304,14 @@ def setup_scheduler():
         replace_existing=True
     )
 
+    # Clean up responded notifications once a day
+    scheduler.add_job(
+        db.delete_responded_notifications,
+        CronTrigger(hour=4, minute=0, timezone=KZ_TZ),
+        id="cleanup_notifications",
+        replace_existing=True
+    )
+
     # End of day processing at 23:59
     scheduler.add_job(
         process_end_of_day,
@@ -1,6 +1,8 @@
 # Translations for Habit Tracker Bot
 # Default language: Kazakh (kk)
 
+from functools import lru_cache
+
 TEXTS = {
     # ============ BUTTONS ============
     "btn_my_habits": {
@@ -1254,10 +1256,16 @@ TEXTS = {
 }
 
 
+@lru_cache(maxsize=512)
+def _template(key: str, lang: str):
+    """Look up the raw (unformatted) text for key, falling back to Kazakh."""
+    text_dict = TEXTS.get(key, {})
+    return text_dict.get(lang, text_dict.get("kk", key))
+
+
 def get_text(key: str, lang: str = "kk", **kwargs) -> str:
     """Get translated text by key."""
-    text_dict = TEXTS.get(key, {})
-    text = text_dict.get(lang, text_dict.get("kk", key))
+    text = _template(key, lang)
 
     if kwargs:
         try: